@@ -0,0 +1,396 @@
+import math
+
+import numpy as np
+
+import engine
+
+# Noise-free per-locale odds, worked out by numerical integration rather than by simulation.
+#
+# The only draw in the model which doesn't simply add to the margins is avgPolledPollError, which scales each
+# polled locale's error (see engine.compute_margins). Once it is fixed, every locale's margin, including the
+# split states derived from other locales, is a sum of independent normal draws times fixed coefficients, and
+# so is normal, with a mean and variance which can be written down. Each locale's win probability and expected
+# margin is then an average over avgPolledPollError of a normal probability, which Gauss-Hermite quadrature
+# gives to many decimal places from a few dozen points. Monte Carlo is only needed for statistics which depend on
+# the order of every locale's margin at once, such as the tipping point
+
+# The standard normal distribution function, from math.erfc so that small tail probabilities keep their
+# precision
+
+_erfc = np.vectorize(math.erfc, otypes=[np.float64])
+
+
+def normal_cdf(x):
+    return 0.5 * _erfc(-np.asarray(x) / math.sqrt(2))
+
+
+def hermite_nodes(n):
+    """Returns the n nodes and weights of Gauss-Hermite quadrature for an average over a standard normal draw"""
+
+    nodes, weights = np.polynomial.hermite_e.hermegauss(n)
+    return nodes, weights / weights.sum()
+
+
+def conditional_model(table, params, pollError):
+    """Returns each locale's margin given avgPolledPollError, as a normal distribution written out in full
+
+    pollError is an array of values of avgPolledPollError. Returns (mean, shared, idiosyncratic), where mean is a
+    (values x locales) array of the expected margins, shared is a (locales x shared draws) array of the
+    coefficients of the draws shared between locales (natMarginED, the national poll error on top of the state
+    poll error, and any correlated error factors, in that order), and idiosyncratic is a (values x locales) array
+    of the variance of the draws which belong to each locale alone. The variance of a margin is the sum of the
+    squares of its shared coefficients plus its idiosyncratic variance
+    """
+
+    pollError = np.asarray(pollError, dtype=np.float64)[:, None]
+    numLocales = len(table.abbrs)
+    numShared = 2 + len(table.factors)
+
+    mean = np.zeros((len(pollError), numLocales))
+    shared = np.zeros((numLocales, numShared))
+    idiosyncratic = np.zeros((len(pollError), numLocales))
+
+    high, low, none = table.high, table.low, table.none
+    trailing = params.trailingDemMargin
+
+    # The same three rules as compute_margins, including leaving out the modifier of the low quality locales
+
+    mean[:, high] = trailing + table.polls[high]
+    idiosyncratic[:, high] = params.stateMarginEDModifierSTD ** 2 + pollError ** 2
+
+    mean[:, low] = trailing + 0.5 * table.polls[low] + 0.5 * (table.priors[low] - params.priorNatMargin)
+    idiosyncratic[:, low] = pollError ** 2
+
+    mean[:, none] = table.priors[none] - params.priorNatMargin + trailing + pollError
+    idiosyncratic[:, none] = params.noPollModifierSTD ** 2
+
+    simulated = np.concatenate([high, low, none])
+    shared[simulated, 0] = params.natMarginEDSTD
+    shared[none, 1] = params.nationalPollErrorSTD
+    shared[:, 2:] = params.factorScale * table.loadings.T
+
+    # An "average" state is a weighted sum of its districts, and a "spread" state's districts are its statewide
+    # margin plus or minus half of districtDiff
+
+    if len(table.averageStates):
+        weights = table.averageWeights
+        mean[:, table.averageStates] = mean @ weights.T
+        shared[table.averageStates] = weights @ shared
+        idiosyncratic[:, table.averageStates] = idiosyncratic @ (weights ** 2).T
+
+    for state, upper, lower in table.spreadStates:
+        for district, sign in ((upper, 1), (lower, -1)):
+            mean[:, district] = mean[:, state] + sign * params.districtDiffMean / 2
+            shared[district] = shared[state]
+            idiosyncratic[:, district] = idiosyncratic[:, state] + (params.districtDiffSTD / 2) ** 2
+
+    return mean, shared, idiosyncratic
+
+
+def locale_odds(table, params, nodes=64):
+    """Returns (localeDemWins, localeDemAvg): each locale's Democratic win % and average margin
+
+    These are what engine.run estimates by simulation, to within its Monte Carlo error, but without any noise.
+    nodes is the number of quadrature points over avgPolledPollError
+    """
+
+    z, weights = hermite_nodes(nodes)
+    mean, shared, idiosyncratic = conditional_model(table, params, params.avgPolledPollErrorSTD * z)
+    std = np.sqrt((shared ** 2).sum(axis=1) + idiosyncratic)
+
+    return 100 * weights @ normal_cdf(mean / std), weights @ mean
+
+
+# The whole distribution of the electoral votes, worked out exactly rather than counted from simulations.
+#
+# Given every draw shared between locales (avgPolledPollError, natMarginED, the national poll error and any
+# correlated error factors), the locales' margins are independent normals, so the chance of Biden winning each
+# number of electoral votes is a product of (1 - p + p x^evs) polynomials, one per locale, which is multiplied out
+# one locale at a time. Averaging that over a Gauss-Hermite grid of the shared draws gives the distribution
+# without any sampling noise, even in the tail bins which hold a handful of simulations in 100,000.
+#
+# The split states are the exception, as their statewide and district margins share a draw, so each one is
+# taken as a group whose joint electoral votes are worked out first:
+#
+#   for an "average" state, the districts' own draws are integrated out by Gauss-Legendre quadrature over their
+#   distribution functions, one district after another, apart from the last, whose chances of being won
+#   alongside the statewide margin are normal probabilities. Each district's range is cut where it changes sign
+#   and where the running statewide margin does, so the quadrature never straddles a kink
+#   for a "spread" state, the statewide draw is integrated out, and the chances of each district being won
+#   follow from the normal districtDiff
+#
+# The cost grows with the product of the number of points on each shared draw, so each correlated error factor
+# multiplies it by factor_nodes. Grid points with a negligible weight are dropped
+
+# Below this product of weights, a point of the grid of shared draws is dropped
+
+minimumWeight = 1e-12
+
+
+def fast_normal_cdf(x):
+    """The standard normal distribution function, to a relative accuracy of about 1e-7
+
+    This is the Chebyshev fit to erfc from Numerical Recipes, which unlike normal_cdf runs at numpy speed, for
+    the millions of probabilities behind the distribution of the electoral votes
+    """
+
+    x = np.asarray(x) / math.sqrt(2)
+    z = np.abs(x)
+    t = 1 / (1 + 0.5 * z)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (-0.18628806
+        + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+    return 0.5 * np.where(x <= 0, r, 2 - r)
+
+
+class EVOdds(object):
+    """The exact distribution of the electoral votes, on the same 0-100 scale as engine.Results
+
+    evs is the probability, in %, of Biden winning each number of electoral votes from 0 to 538
+    demWins, GOPWins and ties are the chances of each party winning the Electoral College or a tie
+    avgDemEVs and avgGOPEVs are the expected electoral votes of each party
+    outcomes is the probability of each of the 16 Electoral College margin bins, as in Results
+    nodes is the number of points on the grid of shared draws that were averaged over
+    """
+
+    def __init__(self, evs, nodes):
+        totalEVs = len(evs) - 1
+        demEVs = np.arange(totalEVs + 1)
+        GOPEVs = totalEVs - demEVs
+
+        self.evs = 100 * evs
+        self.nodes = nodes
+        self.demWins = float(self.evs[demEVs > GOPEVs].sum())
+        self.GOPWins = float(self.evs[GOPEVs > demEVs].sum())
+        self.ties = float(self.evs[demEVs == GOPEVs].sum())
+        self.avgDemEVs = float(self.evs @ demEVs / 100)
+        self.avgGOPEVs = totalEVs - self.avgDemEVs
+        self.outcomes = np.bincount(np.searchsorted(engine.OUTCOME_EDGES, demEVs - GOPEVs, side="right"),
+                                    self.evs, minlength=16)
+
+
+def shared_grid(axes):
+    """Returns (indices, weights): the tensor product of quadrature rules, leaving out negligible points
+
+    axes holds the weights of the rule on each axis. indices is a (grid points x axes) array of which point of
+    each axis's rule each grid point uses, and weights is the product of their weights
+    """
+
+    indices = np.zeros((1, 0), dtype=np.int64)
+    weights = np.ones(1)
+    for axis in axes:
+        indices = np.hstack([np.repeat(indices, len(axis), axis=0),
+                             np.tile(np.arange(len(axis)), len(indices))[:, None]])
+        weights = np.outer(weights, axis).ravel()
+        keep = weights > minimumWeight
+        indices, weights = indices[keep], weights[keep]
+    return indices, weights
+
+
+def normal_ppf(p):
+    """The inverse of the standard normal distribution function, to a relative accuracy of about 1e-9
+
+    This is Acklam's rational approximation, with separate fits to the centre and to each tail
+    """
+
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02, 1.383577518672690e+02,
+         -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02, 6.680131188771972e+01,
+         -1.328068155288572e+01, 1.0)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549671010228477e+00,
+         4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00, 1.0)
+
+    p = np.asarray(p, dtype=np.float64)
+    q = np.minimum(p, 1 - p)
+    tail = np.sqrt(-2 * np.log(np.maximum(q, 1e-300)))
+    x = np.where(p < 0.5, 1, -1) * np.polyval(c, tail) / np.polyval(d, tail)
+    r = (p - 0.5) ** 2
+    centre = (p - 0.5) * np.polyval(a, r) / np.polyval(b, r)
+    return np.where(q > 0.02425, centre, x)
+
+
+def probability_points(mean, std, lower, upper, n):
+    """Returns Gauss-Legendre points and weights for a normal margin between arrays of lower and upper limits
+
+    The quadrature is over the margin's distribution function rather than the margin itself, so the weights
+    already include its density, and the limits can be infinite. The points are on a new last axis
+    """
+
+    z, w = np.polynomial.legendre.leggauss(n)
+    start = fast_normal_cdf((lower - mean) / std)[..., None]
+    end = fast_normal_cdf((upper - mean) / std)[..., None]
+    half = (end - start) / 2
+    return mean[..., None] + std[..., None] * normal_ppf(start + half * (z + 1)), half * w
+
+
+def add_outcomes(histogram, evs, probability):
+    """Adds probability to histogram[row, evs] for every row
+
+    evs and probability have one row per row of histogram, and may have any number of columns
+    """
+
+    rows, width = histogram.shape
+    index = (evs + width * np.arange(rows)[:, None]).ravel()
+    histogram += np.bincount(index, probability.ravel(), minlength=rows * width).reshape(rows, width)
+
+
+def average_group(mean, std, weights, evs, stateEVs, n):
+    """Returns the (grid points x EVs) distribution of the electoral votes of an "average" state and its districts
+
+    mean and std are (grid points x districts) arrays of the districts' margins given the shared draws, weights
+    their weights in the statewide margin and evs their electoral votes
+    """
+
+    rows, numDistricts = mean.shape
+    histogram = np.zeros((rows, int(evs.sum()) + stateEVs + 1))
+
+    # Each quadrature point carries the running statewide margin, the districts' electoral votes and its weight
+
+    statewide = np.zeros((rows, 1))
+    districtEVs = np.zeros((rows, 1), dtype=np.int64)
+    mass = np.ones((rows, 1))
+
+    for x in range(numDistricts - 1):
+        cut = -statewide / weights[x]
+        mu, sigma = np.broadcast_to(mean[:, x, None], cut.shape), np.broadcast_to(std[:, x, None], cut.shape)
+        first, second = np.minimum(cut, 0), np.maximum(cut, 0)
+
+        margins, masses = [], []
+        for start, end in ((-np.inf, first), (first, second), (second, np.inf)):
+            points, w = probability_points(mu, sigma, start, end, n)
+            margins.append(points)
+            masses.append(mass[..., None] * w)
+        margins = np.concatenate(margins, axis=2)
+        masses = np.concatenate(masses, axis=2)
+
+        statewide = (statewide[..., None] + weights[x] * margins).reshape(rows, -1)
+        districtEVs = (districtEVs[..., None] + evs[x] * (margins > 0)).reshape(rows, -1)
+        mass = masses.reshape(rows, -1)
+
+    # The last district wins if its margin is above zero and carries the state if it is above cut
+
+    mu, sigma = mean[:, -1, None], std[:, -1, None]
+    cut = -statewide / weights[-1]
+    district = fast_normal_cdf(mu / sigma)
+    state = fast_normal_cdf((mu - cut) / sigma)
+    both = fast_normal_cdf((mu - np.maximum(cut, 0)) / sigma)
+
+    for won, probability in ((evs[-1] + stateEVs, both), (evs[-1], district - both), (stateEVs, state - both),
+                             (0, 1 - district - state + both)):
+        add_outcomes(histogram, districtEVs + won, mass * probability)
+    return histogram
+
+
+def spread_group(mean, std, params, evs, n):
+    """Returns the (grid points x EVs) distribution of the electoral votes of a "spread" state and its districts
+
+    mean and std are the statewide margin given the shared draws, and evs the electoral votes of the state and
+    its upper and lower districts
+    """
+
+    stateEVs, upperEVs, lowerEVs = evs
+    diffSTD = max(params.districtDiffSTD, 1e-9)
+    histogram = np.zeros((len(mean), stateEVs + upperEVs + lowerEVs + 1))
+
+    for start, end, won in ((-np.inf, 0, 0), (0, np.inf, stateEVs)):
+        margins, mass = probability_points(mean, std, start, end, n)
+
+        # The upper district is won if districtDiff > -2 x margin and the lower one if districtDiff < 2 x margin
+
+        upper = fast_normal_cdf((params.districtDiffMean + 2 * margins) / diffSTD)
+        lower = fast_normal_cdf((2 * margins - params.districtDiffMean) / diffSTD)
+        both = np.maximum(upper + lower - 1, 0)
+        for districtEVs, probability in ((upperEVs + lowerEVs, both), (upperEVs, upper - both),
+                                         (lowerEVs, lower - both), (0, 1 - upper - lower + both)):
+            add_outcomes(histogram, np.full(margins.shape, won + districtEVs), mass * probability)
+    return histogram
+
+
+def add_locale(distribution, reach, evs, probability):
+    """Adds a locale worth evs, won with probability, to a distribution of the electoral votes, in place
+
+    Only the first reach columns of distribution, the electoral votes of the locales added so far, can be
+    nonzero, so only they are worked on
+    """
+
+    won = distribution[:, :reach] * probability[:, None]
+    distribution[:, :reach] -= won
+    distribution[:, evs:evs + reach] += won
+
+
+def add_group(distribution, reach, histogram):
+    """Adds a split state group, with the given distribution of its electoral votes, to distribution in place"""
+
+    before = distribution[:, :reach].copy()
+    distribution[:, :reach] *= histogram[:, :1]
+    for evs in range(1, histogram.shape[1]):
+        distribution[:, evs:evs + reach] += before * histogram[:, evs, None]
+
+
+def ev_odds(table, params, nodes=24, factor_nodes=6, inner_nodes=10, batch=256):
+    """Returns the exact distribution of the electoral votes as EVOdds
+
+    This is what engine.run estimates from its demEVs counts, without the sampling noise. nodes is the number of
+    Gauss-Hermite points on each of avgPolledPollError, natMarginED and the national poll error, factor_nodes
+    the number on each correlated error factor and inner_nodes the number of Gauss-Legendre points on each piece
+    of a split state district's margin. The grid is worked through batch points at a time
+    """
+
+    z, zWeights = hermite_nodes(nodes)
+    mean, shared, idiosyncratic = conditional_model(table, params, params.avgPolledPollErrorSTD * z)
+
+    # Shared draws which no locale depends on (such as the national poll error when its standard deviation is
+    # zero) get a single point at zero
+
+    rules = [(z, zWeights)]
+    for x in range(shared.shape[1]):
+        if np.any(shared[:, x]):
+            rules.append(hermite_nodes(nodes if x < 2 else factor_nodes))
+        else:
+            rules.append((np.zeros(1), np.ones(1)))
+    indices, weights = shared_grid([w for _, w in rules])
+    pollError = indices[:, 0]
+    points = np.column_stack([rules[x + 1][0][indices[:, x + 1]] for x in range(shared.shape[1])])
+    evs = table.evs.astype(np.int64)
+    totalEVs = int(evs.sum())
+
+    # The columns in a split state group are handled together, and every other locale on its own
+
+    grouped = np.zeros(len(table.abbrs), dtype=bool)
+    averageGroups = []
+    for state, stateWeights in zip(table.averageStates, table.averageWeights):
+        districts = np.flatnonzero(stateWeights)
+        averageGroups.append((state, districts, stateWeights[districts]))
+        grouped[districts] = grouped[state] = True
+    for group in table.spreadStates:
+        grouped[list(group)] = True
+    alone = np.flatnonzero(~grouped)
+
+    evDistribution = np.zeros(totalEVs + 1)
+    for start in range(0, len(points), batch):
+        rows = slice(start, start + batch)
+        localeMean = mean[pollError[rows]] + points[rows] @ shared.T
+        localeSTD = np.maximum(np.sqrt(idiosyncratic[pollError[rows]]), 1e-9)
+
+        distribution = np.zeros((len(localeMean), totalEVs + 1))
+        distribution[:, 0] = 1
+        reach = 1
+        won = fast_normal_cdf(localeMean / localeSTD)
+        for x in alone:
+            add_locale(distribution, reach, evs[x], won[:, x])
+            reach += evs[x]
+
+        for state, districts, stateWeights in averageGroups:
+            histogram = average_group(localeMean[:, districts], localeSTD[:, districts], stateWeights,
+                                      evs[districts], evs[state], inner_nodes)
+            add_group(distribution, reach, histogram)
+            reach += histogram.shape[1] - 1
+        for state, upper, lower in table.spreadStates:
+            histogram = spread_group(localeMean[:, state], localeSTD[:, state], params,
+                                     (evs[state], evs[upper], evs[lower]), inner_nodes)
+            add_group(distribution, reach, histogram)
+            reach += histogram.shape[1] - 1
+
+        evDistribution += weights[rows] @ distribution
+
+    return EVOdds(evDistribution, len(points))
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import engine
+import loader
+import sweep
+
+# Backtests the model against past elections. Each election cycle has its own directory, data/<year>/, holding
+# its locales.csv and results.csv (see loader.py), an optional factors.csv (only used with --factors), and a
+# cycle.json giving the Params fields that belong to the cycle rather than to the model (CYCLE_FIELDS), such as
+#
+#   {"trailingDemMargin": 6.33, "priorNatMargin": 2.1}
+#
+# These are facts about the cycle, so they always come from cycle.json and can't be swept or fitted
+#
+# Every cycle with a results file is simulated with the model's hyperparameters, the cycles running in parallel,
+# and the forecast for every locale is scored against what actually happened:
+#
+#   brier is the mean squared difference between each locale's Democratic win probability and its outcome (1 for
+#   a Democratic win, 0 otherwise); 0 is perfect and always saying 50% scores 0.25
+#   logLoss is the mean of -log(the probability given to what actually happened); probabilities are kept at least
+#   half a simulation away from 0 and 1, so that an outcome none of the simulations produced isn't infinitely bad
+#   coverage50, coverage80 and coverage95 are the percentages of locales whose actual margin fell within the
+#   central 50%, 80% and 95% of their simulated margins. A well calibrated model covers about 50, 80 and 95%
+#   correctCalls and avgMiss are the scores from the original 2020 comparison in NeoSlim.py: the number of
+#   locales whose average margin had the right sign, and the average absolute difference from the actual margin
+#
+# "python backtest.py --param noPollModifierSTD=5,5.59,6.5" backtests every combination of the values given, so
+# that the model's constants can be recalibrated in a single run
+
+DATA_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+COVERAGE_LEVELS = [50, 80, 95]
+
+# The Params fields which describe a cycle rather than the model, and which a cycle.json may set
+
+CYCLE_FIELDS = ["trailingDemMargin", "priorNatMargin"]
+MODEL_FIELDS = [x for x in engine.Params.FIELDS if x not in CYCLE_FIELDS]
+
+
+def find_cycles(dataRoot=DATA_ROOT):
+    """Returns the names of the cycle directories under dataRoot which have both locales and results files"""
+
+    return sorted(x for x in os.listdir(dataRoot)
+                  if os.path.exists(os.path.join(dataRoot, x, "locales.csv"))
+                  and os.path.exists(os.path.join(dataRoot, x, "results.csv")))
+
+
+def load_cycle(cycle, params, dataRoot=DATA_ROOT, factors=False):
+    """Returns the LocaleTable of a cycle, with its actual results, and its Params
+
+    If factors is true, the cycle's correlated error factors are loaded too, if it has any. The cycle's
+    cycle.json, if it has one, overrides the matching fields of params
+    """
+
+    cycleDir = os.path.join(dataRoot, cycle)
+    table = loader.load_table(os.path.join(cycleDir, "locales.csv"), os.path.join(cycleDir, "results.csv"))
+
+    factorsPath = os.path.join(cycleDir, "factors.csv")
+    if factors and os.path.exists(factorsPath):
+        loader.load_factors(factorsPath, table)
+
+    return table, params.replace(**cycle_params(cycle, dataRoot))
+
+
+def cycle_params(cycle, dataRoot=DATA_ROOT):
+    """Returns the dict of Params fields set by a cycle's cycle.json (empty if it has none)
+
+    Raises a ValueError if it sets anything but the CYCLE_FIELDS
+    """
+
+    cyclePath = os.path.join(dataRoot, cycle, "cycle.json")
+    if not os.path.exists(cyclePath):
+        return {}
+    with open(cyclePath) as f:
+        fields = json.load(f)
+    unknown = set(fields) - set(CYCLE_FIELDS)
+    if unknown:
+        raise ValueError(cyclePath + " sets " + ", ".join(sorted(unknown)) + "; a cycle may only set " +
+                         ", ".join(CYCLE_FIELDS))
+    return fields
+
+
+def backtest_chunk(chunkSeed, chunkSims, table, params):
+    """Simulates a single chunk and returns its Tally and, for each locale, how many margins fell below the
+    actual margin
+    """
+
+    draws = engine.draw_normals(np.random.default_rng(chunkSeed), chunkSims, table)
+    margins, natMarginED, avgNationalPollError = engine.compute_margins(draws, table, params)
+
+    tally = engine.Tally(table, tips=False)
+    tally.add(margins, natMarginED, avgNationalPollError)
+    return tally, (margins < table.actualDemMargin).sum(axis=0)
+
+
+def score_cycle(cycle, params, n_sims=100000, chunk_size=10000, seed=None, workers=1, dataRoot=DATA_ROOT,
+                factors=False):
+    """Simulates one cycle and returns a dict of its scores, as described at the top of this file
+
+    The dict starts with the fields of the Params actually simulated, after the cycle's own fields have been
+    applied, and also holds the cycle, the number of locales and the Dem win % and average EVs, with the actual
+    EVs and winner worked out from the results file
+    """
+
+    table, params = load_cycle(cycle, params, dataRoot, factors)
+    numLocales = len(table.abbrs)
+
+    tally = engine.Tally(table, tips=False)
+    below = np.zeros(numLocales, dtype=np.int64)
+    for chunkTally, chunkBelow in engine.map_chunks(backtest_chunk, table, (params,), n_sims, chunk_size, seed,
+                                                    workers):
+        tally.merge(chunkTally)
+        below += chunkBelow
+    results = tally.results()
+
+    actual = table.actualDemMargin
+    demWon = actual > 0
+    probability = np.clip(results.localeDemWins / 100, 0.5 / n_sims, 1 - 0.5 / n_sims)
+
+    # Where each actual margin fell among the simulated margins, from 0 (below all of them) to 1 (above all of
+    # them). It falls within the central c% of them if this is within c / 2 of one half
+
+    rank = below / n_sims
+
+    actualDemEVs = int(table.evs[demWon].sum())
+    row = params.as_dict()
+    row.update({
+        "cycle": cycle,
+        "locales": numLocales,
+        "brier": float(np.mean((probability - demWon) ** 2)),
+        "logLoss": float(-np.mean(np.log(np.where(demWon, probability, 1 - probability)))),
+    })
+    for level in COVERAGE_LEVELS:
+        row["coverage" + str(level)] = float(100 * np.mean(np.abs(rank - 0.5) <= level / 200))
+    row["correctCalls"] = int(np.count_nonzero((results.localeDemAvg > 0) == demWon))
+    row["avgMiss"] = float(np.mean(np.abs(results.localeDemAvg - actual)))
+    row["demWins"] = results.demWins
+    row["avgDemEVs"] = results.avgDemEVs
+    row["actualDemEVs"] = actualDemEVs
+    row["actualWinner"] = "Dem" if 2 * actualDemEVs > table.evs.sum() else "GOP"
+    return row
+
+
+def backtest(cycles, paramSets, n_sims=100000, chunk_size=10000, seed=None, workers=1, dataRoot=DATA_ROOT,
+             factors=False):
+    """Scores every set of Params against every cycle and returns a list of rows, one per pair
+
+    Each row is as returned by score_cycle. The pairs are shared between worker processes; with a single pair
+    the workers share out its chunks instead. The same seed is used for every pair, so the differences between
+    sets of Params aren't blurred by Monte Carlo noise
+    """
+
+    jobs = [(cycle, params) for params in paramSets for cycle in cycles]
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1 or len(jobs) == 1:
+        scores = [score_cycle(cycle, params, n_sims, chunk_size, seed, workers, dataRoot, factors)
+                  for cycle, params in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            scores = list(pool.map(score_cycle, [x[0] for x in jobs], [x[1] for x in jobs],
+                                   *[[x] * len(jobs) for x in (n_sims, chunk_size, seed, 1, dataRoot, factors)]))
+
+    return scores
+
+
+def print_rows(rows, varied):
+    columns = varied + ["cycle", "brier", "logLoss"] + ["coverage" + str(x) for x in COVERAGE_LEVELS] + \
+        ["correctCalls", "avgMiss", "demWins", "avgDemEVs", "actualDemEVs"]
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(str(round(row[x], 4)) if isinstance(row[x], float) else str(row[x]) for x in columns))
+
+
+def parse_param(text):
+    """Parses a --param option of the form name=value[,value...] into (name, [values])"""
+
+    name, _, values = text.partition("=")
+    if name in CYCLE_FIELDS:
+        raise argparse.ArgumentTypeError(name + " is set by each cycle's cycle.json and can't be varied")
+    if name not in engine.Params.FIELDS or not values:
+        raise argparse.ArgumentTypeError("expected one of " + ", ".join(MODEL_FIELDS) + " = values")
+    return name, [float(x) for x in values.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backtests the model against past election cycles")
+    parser.add_argument("--cycles", nargs="+", help="cycles to backtest (by default every one with results)")
+    parser.add_argument("--param", type=parse_param, action="append", default=[],
+                        help="a hyperparameter and the values to try, as name=value,value,...")
+    parser.add_argument("--sims", type=int, default=100000, help="simulations per cycle")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default one per CPU)")
+    parser.add_argument("--data-root", default=DATA_ROOT, help="directory holding a directory per cycle")
+    parser.add_argument("--factors", action="store_true", help="use each cycle's correlated error factors")
+    parser.add_argument("--csv", help="also write the table to this CSV file")
+    args = parser.parse_args(argv)
+
+    cycles = args.cycles or find_cycles(args.data_root)
+    values = dict(args.param)
+    paramSets = sweep.grid(**values)
+
+    rows = backtest(cycles, paramSets, args.sims, args.chunk_size, args.seed, args.workers, args.data_root,
+                    args.factors)
+    print_rows(rows, list(values))
+    if args.csv:
+        sweep.write_csv(rows, args.csv)
+
+
+if __name__ == "__main__":
+    main()
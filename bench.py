@@ -0,0 +1,346 @@
+import argparse
+import operator
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import analytic
+import engine
+import loader
+import reference
+
+# Benchmarks for the simulation engine, and a statistical check that it still gives the same answers as the
+# original pure-Python loop (kept in reference.py). Run this file directly; "python bench.py --help" lists the
+# options
+
+# The 2020 locales, whose electoral votes and districts are used to make the benchmarks realistic
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "2020")
+
+# Made-up regional factor loadings, which only exercise the factor model and aren't fitted to any cycle
+
+EXAMPLE_FACTORS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "factors.csv")
+
+
+def bench_table(factors=False):
+    table = loader.load_table(os.path.join(DATA_DIR, "locales.csv"))
+    if factors:
+        loader.load_factors(EXAMPLE_FACTORS, table)
+    return table
+
+
+class benchLocale(object):
+    """A stripped down stand-in for NeoSlim's locale class, holding just what the old tipping point code used"""
+
+    def __init__(self, index, evs, demMargin):
+        self.index = index
+        self.evs = evs
+        self.demMargin = demMargin
+
+
+def bench_margins(nSims, numLocales, seed=0):
+    """Draws an (nSims x numLocales) matrix of margins with a shared national swing, spread like a real election"""
+
+    rng = np.random.default_rng(seed)
+    centres = np.linspace(-40, 40, numLocales)
+    rng.shuffle(centres)
+    return centres + rng.normal(6, 4, (nSims, 1)) + rng.normal(0, 6, (nSims, numLocales))
+
+
+def sorted_objects_tips(margins, evs, isDistrict):
+    """The tipping point and smallest margin code from the original loop, one simulation at a time
+
+    Returns arrays of tipping point and smallest margin indices so they can be checked against the kernels
+    """
+
+    tips = np.zeros(len(margins), dtype=np.int64)
+    sms = np.zeros(len(margins), dtype=np.int64)
+
+    for y in range(len(margins)):
+        allStates = [benchLocale(x, evs[x], margins[y, x]) for x in range(len(evs))]
+        demEVs = sum(x.evs for x in allStates if x.demMargin > 0)
+        GOPEVs = sum(evs) - demEVs
+
+        tipCount = 0
+        statesPos = 0
+        allStates = sorted(allStates, key=operator.attrgetter('demMargin'))
+        if demEVs > GOPEVs:
+            allStates.reverse()
+            while tipCount < 270:
+                tipCount = tipCount + allStates[statesPos].evs
+                statesPos = statesPos + 1
+        elif GOPEVs > demEVs:
+            while tipCount < 270:
+                tipCount = tipCount + allStates[statesPos].evs
+                statesPos = statesPos + 1
+        tips[y] = allStates[statesPos - 1].index
+
+        for x in allStates:
+            x.demMargin = abs(x.demMargin)
+        allStates = sorted(allStates, key=operator.attrgetter('demMargin'))
+        smCount = 0
+        while isDistrict[allStates[smCount].index]:
+            smCount = smCount + 1
+        sms[y] = allStates[smCount].index
+
+    return tips, sms
+
+
+def argsort_tips(margins, evs, demEVs, GOPEVs):
+    """The first vectorized version: a full argsort of every row"""
+
+    demWin = (demEVs > GOPEVs)[:, None]
+    order = np.argsort(np.where(demWin, -margins, margins), axis=1)
+    cumEVs = np.cumsum(evs[order], axis=1)
+    tips = order[np.arange(len(margins)), np.argmax(cumEVs >= 270, axis=1)]
+    tied = demEVs == GOPEVs
+    tips[tied] = np.argmax(margins[tied], axis=1)
+    return tips
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_tipping_points(nSims=100000, nSlow=20000):
+    """Times the three ways of finding the tipping point and smallest margin and checks that they agree"""
+
+    table = bench_table()
+    evs = table.evs
+    isDistrict = table.isDistrict
+    margins = bench_margins(nSims, len(evs))
+    demEVs = (margins > 0) @ evs
+    GOPEVs = evs.sum() - demEVs
+
+    # The original code is far too slow to run over every simulation, so it is timed on the first nSlow and
+    # scaled up
+
+    (slowTips, slowSms), slowTime = timed(sorted_objects_tips, margins[:nSlow], evs, isDistrict)
+    sortTips, sortTime = timed(argsort_tips, margins, evs, demEVs, GOPEVs)
+    kernelTips, kernelTime = timed(engine.find_tipping_points, margins, evs, demEVs, GOPEVs)
+    kernelSms, smTime = timed(engine.find_smallest_margins, margins, isDistrict)
+
+    print("Tipping point and smallest margin,", nSims, "simulations")
+    print("Sorted locale objects:", "\t", round(slowTime * nSims / nSlow, 3), "s (estimated from", nSlow, ")")
+    print("Full argsort:", "\t", "\t", round(sortTime + smTime, 3), "s")
+    print("Partition kernel:", "\t", round(kernelTime + smTime, 3), "s")
+    print("Tips agree:", "\t", "\t", np.array_equal(slowTips, kernelTips[:nSlow])
+          and np.array_equal(sortTips, kernelTips))
+    print("Smallest margins agree:", "\t", np.array_equal(slowSms, kernelSms[:nSlow]))
+
+
+def measure(function, *args, **kwargs):
+    """Runs a function and returns (result, seconds, peak MB allocated while it ran)
+
+    Memory is tracked with tracemalloc, which NumPy reports its arrays to. tracemalloc slows everything down, so
+    the function is timed on a separate, untracked run; memory=False skips the tracked run altogether
+    """
+
+    memory = kwargs.pop("memory", True)
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def bench_engine(sizes, referenceMax=100000, workers=1, chunkSize=10000, seed=0, memory=True):
+    """Times the reference loop and the engine at each number of simulations and prints draws/sec and memory
+
+    The reference loop is only run up to referenceMax simulations, as 10M would take the best part of an hour.
+    Its memory use doesn't depend on the number of simulations, so it is measured once on a small run. Peak
+    memory is only measured in this process, so it leaves out the worker processes when workers > 1
+    """
+
+    table = bench_table()
+    params = engine.Params()
+
+    referencePeak = measure(reference.run_reference, table, params, 1000, seed)[2]
+
+    print("Engine", "\t", "\t", "Simulations", "\t", "Seconds", "\t", "Draws/sec", "\t", "Peak MB")
+    for nSims in sizes:
+        if nSims <= referenceMax:
+            result, elapsed, peak = measure(reference.run_reference, table, params, nSims, seed, memory=False)
+            print("Pure Python", "\t", nSims, "\t", "\t", round(elapsed, 3), "\t", "\t", int(nSims / elapsed),
+                  "\t", "\t", round(referencePeak, 2) if memory else "-")
+        result, elapsed, peak = measure(engine.run, table, params, n_sims=nSims, chunk_size=chunkSize, seed=seed,
+                                        workers=workers, memory=memory)
+        print("Vectorized", "\t", nSims, "\t", "\t", round(elapsed, 3), "\t", "\t", int(nSims / elapsed), "\t",
+              "\t", round(peak, 2) if memory else "-")
+
+
+def bench_factors(nSims=1000000, chunkSize=10000, seed=0, memory=True):
+    """Times the engine with no correlated error factors, the two example regional factors, and a full
+    56-factor covariance model (the Cholesky factor of the regional covariance plus some independent noise)
+
+    Also prints the correlation between the WI and MI margins under each, to show what the factors do
+    """
+
+    params = engine.Params()
+    plain = bench_table()
+    regional = bench_table(factors=True)
+
+    full = bench_table()
+    covariance = regional.loadings.T @ regional.loadings + np.eye(len(full.abbrs))
+    full.set_loadings(["locale" + str(x) for x in range(len(full.abbrs))],
+                      engine.loadings_from_covariance(covariance))
+
+    pair = [plain.index["WI"], plain.index["MI"]]
+
+    print("Correlated errors, ", nSims, "simulations")
+    print("Factors", "\t", "Seconds", "\t", "Draws/sec", "\t", "Peak MB", "\t", "WI-MI correlation")
+    for name, table in [("None", plain), ("Regional", regional), ("Full", full)]:
+        result, elapsed, peak = measure(engine.run, table, params, n_sims=nSims, chunk_size=chunkSize, seed=seed,
+                                        memory=memory)
+        margins = engine.draw_margins(np.random.default_rng(seed), 100000, table, params)[0]
+        correlation = np.corrcoef(margins[:, pair].T)[0, 1]
+        print(name, "\t", "\t", round(elapsed, 3), "\t", "\t", int(nSims / elapsed), "\t", "\t",
+              round(peak, 2) if memory else "-", "\t", "\t", round(correlation, 3))
+
+
+def bench_exact_evs(sizes, workers=1, seed=0):
+    """Times the exact distribution of the electoral votes against simulations of each size in sizes
+
+    For each size, prints the largest difference between the simulated and exact outcome bins, in points, with
+    its z-score. The quadrature error of the exact figures is estimated by comparing them with a finer grid,
+    and so is the number of simulations whose standard error in the widest bin would be that small
+    """
+
+    table = bench_table()
+    params = engine.Params()
+
+    start = time.perf_counter()
+    exact = analytic.ev_odds(table, params)
+    elapsed = time.perf_counter() - start
+    fine = analytic.ev_odds(table, params, nodes=48, inner_nodes=16)
+    error = np.abs(exact.outcomes - fine.outcomes).max() / 100
+    widest = exact.outcomes.max() / 100
+    matching = widest * (1 - widest) / error ** 2
+
+    print("Exact EV distribution:", round(elapsed, 3), "seconds over", exact.nodes, "grid points;",
+          "largest bin error", "%.1e" % (100 * error), "points, which takes", "%.1e" % matching, "simulations")
+    print("Sims", "\t", "Seconds", "\t", "Largest bin difference", "\t", "z")
+    for nSims in sizes:
+        start = time.perf_counter()
+        result = engine.run(table, params, n_sims=nSims, seed=seed, workers=workers)
+        seconds = time.perf_counter() - start
+        difference = np.abs(result.outcomes - exact.outcomes)
+        se = np.sqrt(exact.outcomes * (100 - exact.outcomes) / nSims)
+        worst = int(np.argmax(difference))
+        print(nSims, "\t", round(seconds, 3), "\t", "\t", round(float(difference[worst]), 4), "\t", "\t", "\t",
+              round(float(difference[worst] / se[worst]), 2))
+
+
+def proportion_z(a, b, nA, nB):
+    """Returns the z-scores of the differences between two sets of percentages from independent samples
+
+    A couple of simulations' worth of slack is allowed so that very rare events, seen once in one run and not
+    at all in the other, don't count as differences
+    """
+
+    a = np.asarray(a) / 100
+    b = np.asarray(b) / 100
+    pooled = (a * nA + b * nB) / (nA + nB)
+    se = np.sqrt(pooled * (1 - pooled) * (1 / nA + 1 / nB))
+    slack = 2 / min(nA, nB)
+    return np.maximum(np.abs(a - b) - slack, 0) / np.where(se > 0, se, 1)
+
+
+def check_equivalence(nSims=100000, seed=0, z=5, workers=1):
+    """Checks that the engine's results match the reference loop's within Monte Carlo tolerance
+
+    Both are run with the same seed (which, as they draw their random numbers differently, fixes the outcome of
+    the check rather than pairing up the draws). Every per-locale win %, average margin, tipping point % and
+    smallest margin %, every outcome bin, and the national figures are compared, and any difference of more
+    than z standard errors fails. With a few hundred comparisons, z=5 keeps false alarms to well under one in a
+    thousand runs while still catching any real change to the model
+
+    Returns True if everything matches
+    """
+
+    table = bench_table()
+    params = engine.Params()
+
+    ref = reference.run_reference(table, params, nSims, seed)
+    new = engine.run(table, params, n_sims=nSims, seed=seed, workers=workers)
+
+    # The standard errors of the averages need the spread of the margins and EVs, which are estimated from a
+    # separate sample of engine draws
+
+    margins = engine.draw_margins(np.random.default_rng(seed), 100000, table, params)[0]
+    marginSTD = margins.std(axis=0)
+    evsSTD = ((margins > 0) @ table.evs).std()
+    se = np.sqrt(2 / nSims)
+
+    checks = [
+        ("National win/loss/tie %", proportion_z([ref.demWins, ref.GOPWins, ref.ties],
+                                                  [new.demWins, new.GOPWins, new.ties], nSims, nSims)),
+        ("EC winner loses PV %", proportion_z([ref.PVWinnerLoses], [new.PVWinnerLoses], nSims, nSims)),
+        ("Average Dem EVs", np.abs([ref.avgDemEVs - new.avgDemEVs]) / (evsSTD * se)),
+        ("Outcome bins", proportion_z(ref.outcomes, new.outcomes, nSims, nSims)),
+        ("Locale Dem win %", proportion_z(ref.localeDemWins, new.localeDemWins, nSims, nSims)),
+        ("Locale average margin", np.abs(ref.localeDemAvg - new.localeDemAvg) / (marginSTD * se)),
+        ("Locale tipping point %", proportion_z(ref.localeTip, new.localeTip, nSims, nSims)),
+        ("Locale smallest margin %", proportion_z(ref.localeSm, new.localeSm, nSims, nSims)),
+    ]
+
+    print("Equivalence with the reference loop,", nSims, "simulations, seed", seed)
+    passed = True
+    for name, zScores in checks:
+        worst = int(np.argmax(zScores))
+        ok = zScores[worst] <= z
+        passed = passed and ok
+        where = ""
+        if len(zScores) == len(table.abbrs):
+            where = " (" + table.abbrs[worst] + ")"
+        print(name + ":", "\t", "worst z =", round(float(zScores[worst]), 2), where, "\t", "OK" if ok else "FAIL")
+
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks and checks the NeoSlim simulation engine")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000, 10000000],
+                        help="numbers of simulations to time")
+    parser.add_argument("--reference-max", type=int, default=100000,
+                        help="largest number of simulations to time the pure-Python loop at")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the engine")
+    parser.add_argument("--check-sims", type=int, default=100000,
+                        help="simulations for the equivalence check (0 to skip it)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the extra runs that measure peak memory")
+    parser.add_argument("--tipping-points", action="store_true",
+                        help="also benchmark the tipping point kernel against the old sorts")
+    parser.add_argument("--factors", action="store_true",
+                        help="also benchmark the correlated error factor models at the largest size")
+    parser.add_argument("--exact-evs", action="store_true",
+                        help="also compare the exact EV distribution with simulations of each size")
+    args = parser.parse_args()
+
+    bench_engine(args.sizes, args.reference_max, args.workers, seed=args.seed, memory=not args.no_memory)
+    print()
+    if args.tipping_points:
+        bench_tipping_points()
+        print()
+    if args.factors:
+        bench_factors(max(args.sizes), seed=args.seed, memory=not args.no_memory)
+        print()
+    if args.exact_evs:
+        bench_exact_evs(args.sizes, args.workers, args.seed)
+        print()
+    if args.check_sims and not check_equivalence(args.check_sims, args.seed, workers=args.workers):
+        sys.exit(1)
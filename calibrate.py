@@ -0,0 +1,167 @@
+import argparse
+import math
+
+import numpy as np
+
+import backtest
+import engine
+
+# Fits the model's "semi-subjective" standard deviations to past results by minimising a proper scoring rule
+# over the backtest cycles (see backtest.py for where their inputs live).
+#
+# Every standard deviation in the model only scales a standard normal draw (see compute_margins), so the draws
+# for each cycle are made once, up front, and every trial set of hyperparameters is scored by rescaling those
+# same draws. This is much quicker than simulating afresh for every trial, and as every trial sees the same
+# draws (common random numbers), the objective changes smoothly with the hyperparameters rather than jumping
+# about with Monte Carlo noise, so the search can follow it.
+#
+# The scores, all of which are lower for better forecasts, are
+#
+#   crps, the continuous ranked probability score of each locale's simulated margins against its actual margin,
+#   in points. It rewards putting the margins near the actual one and penalises spreading them more widely than
+#   needed, and it is the default because it changes continuously as the draws are rescaled
+#   brier and logLoss, as in backtest.py. They only depend on how many draws each locale is won in, so they move
+#   in steps, which the search can get stuck on
+
+# The hyperparameters fitted by default: every standard deviation in the model
+
+FITTED = ["natMarginEDSTD", "stateMarginEDModifierSTD", "avgPolledPollErrorSTD", "nationalPollErrorSTD",
+          "noPollModifierSTD", "districtDiffSTD"]
+
+SCORES = ["crps", "brier", "logLoss"]
+
+
+def crps(margins, actual):
+    """Returns the average continuous ranked probability score of each column of margins against actual
+
+    This is E|X - y| - E|X - X'| / 2 for the simulated margins X of a locale and its actual margin y. With the
+    margins sorted, the second term is a weighted sum, so the score takes one sort per locale rather than
+    comparing every pair of simulations
+    """
+
+    nSims = len(margins)
+    ordered = np.sort(margins, axis=0)
+    weights = (2 * np.arange(1, nSims + 1) - nSims - 1) / nSims ** 2
+    return float(np.mean(np.abs(margins - actual).mean(axis=0) - weights @ ordered))
+
+
+def score(margins, actual, kind):
+    """Returns the crps, brier or logLoss score of a matrix of simulated margins against the actual margins"""
+
+    if kind == "crps":
+        return crps(margins, actual)
+
+    nSims = len(margins)
+    probability = np.clip((margins > 0).mean(axis=0), 0.5 / nSims, 1 - 0.5 / nSims)
+    demWon = actual > 0
+    if kind == "brier":
+        return float(np.mean((probability - demWon) ** 2))
+    elif kind == "logLoss":
+        return float(-np.mean(np.log(np.where(demWon, probability, 1 - probability))))
+    raise ValueError("Unknown score " + repr(kind) + "; expected one of " + ", ".join(SCORES))
+
+
+class Objective(object):
+    """Scores sets of Params against the backtest cycles, reusing one set of draws per cycle
+
+    cycles holds a (table, cycle Params fields, Draws) tuple for each cycle
+    kind is the score to use, from SCORES
+    evaluations counts the sets of Params scored so far
+    """
+
+    def __init__(self, cycles, n_sims=20000, seed=0, kind="crps", dataRoot=backtest.DATA_ROOT, factors=False):
+        if kind not in SCORES:
+            raise ValueError("Unknown score " + repr(kind) + "; expected one of " + ", ".join(SCORES))
+
+        self.kind = kind
+        self.evaluations = 0
+        self.cycles = []
+
+        seeds = np.random.SeedSequence(seed).spawn(len(cycles))
+        for cycle, cycleSeed in zip(cycles, seeds):
+            table = backtest.load_cycle(cycle, engine.Params(), dataRoot, factors)[0]
+            draws = engine.draw_normals(np.random.default_rng(cycleSeed), n_sims, table)
+            self.cycles.append((table, backtest.cycle_params(cycle, dataRoot), draws))
+
+    def __call__(self, params):
+        """Returns the average score of params over the cycles"""
+
+        self.evaluations += 1
+        scores = []
+        for table, cycleParams, draws in self.cycles:
+            margins = engine.compute_margins(draws, table, params.replace(**cycleParams))[0]
+            scores.append(score(margins, table.actualDemMargin, self.kind))
+        return float(np.mean(scores))
+
+
+def calibrate(objective, start, names=FITTED, step=0.25, tolerance=0.01, max_evals=300, progress=None):
+    """Searches for the Params that minimise objective, varying only the fields in names, and returns
+    (Params, score)
+
+    This is a compass search on the logarithm of each hyperparameter, which keeps them all positive: each one in
+    turn is scaled up and down by a factor of exp(step), and any change which lowers the score is kept. When no
+    change helps, the step is halved, until it is below tolerance or max_evals trials have been scored. It needs
+    no derivatives, which the Monte Carlo objective doesn't have. progress, if given, is called with each
+    improved (Params, score). The fields each cycle sets for itself (backtest.CYCLE_FIELDS) can't be fitted
+    """
+
+    fixed = set(names).intersection(backtest.CYCLE_FIELDS)
+    if fixed:
+        raise ValueError(", ".join(sorted(fixed)) + " are set by each cycle and can't be fitted")
+
+    best = start
+    bestScore = objective(best)
+
+    while step >= tolerance and objective.evaluations < max_evals:
+        improved = False
+        for name in names:
+            for direction in (1, -1):
+                if objective.evaluations >= max_evals:
+                    break
+                trial = best.replace(**{name: getattr(best, name) * math.exp(direction * step)})
+                trialScore = objective(trial)
+                if trialScore < bestScore:
+                    best, bestScore = trial, trialScore
+                    improved = True
+                    if progress is not None:
+                        progress(best, bestScore)
+                    break
+        if not improved:
+            step /= 2
+
+    return best, bestScore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fits the model's standard deviations to past election results")
+    parser.add_argument("--cycles", nargs="+", help="cycles to fit to (by default every one with results)")
+    parser.add_argument("--fit", nargs="+", default=FITTED, choices=backtest.MODEL_FIELDS,
+                        help="hyperparameters to fit")
+    parser.add_argument("--score", default="crps", choices=SCORES)
+    parser.add_argument("--sims", type=int, default=20000, help="draws per cycle, made once and reused")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-evals", type=int, default=300, help="most trial sets of hyperparameters to score")
+    parser.add_argument("--data-root", default=backtest.DATA_ROOT, help="directory holding a directory per cycle")
+    parser.add_argument("--factors", action="store_true", help="use each cycle's correlated error factors")
+    args = parser.parse_args(argv)
+
+    cycles = args.cycles or backtest.find_cycles(args.data_root)
+    objective = Objective(cycles, args.sims, args.seed, args.score, args.data_root, args.factors)
+    start = engine.Params()
+
+    def progress(params, value):
+        print(objective.evaluations, "\t", round(value, 5), "\t",
+              ", ".join(x + "=" + str(round(getattr(params, x), 3)) for x in args.fit))
+
+    print("Trials", "\t", args.score, "\t", "Hyperparameters")
+    progress(start, objective(start))
+    best, bestScore = calibrate(objective, start, args.fit, max_evals=args.max_evals, progress=progress)
+
+    print()
+    print("Best", args.score, "after", objective.evaluations, "trials:", round(bestScore, 5))
+    for name in args.fit:
+        print(name, "\t", round(getattr(start, name), 3), "->", round(getattr(best, name), 3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,797 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import instrument
+
+# This is a vectorized version of the simulation loop that used to live in NeoSlim.py. Rather than looping over
+# the simulations one at a time and calling random.gauss for every locale, every simulation is drawn at once as
+# a (simulations x locales) matrix of Democratic margins and the statistics are computed from that matrix
+
+# The lower edges of the PredictIt Electoral College margin bins used for "outcomes". A Democratic EV margin of
+# -280 or less falls in the first bin, -279 through -210 in the second, and so on up to 280 or more in the last
+
+OUTCOME_EDGES = np.array([-279, -209, -149, -99, -59, -29, -9, 1, 10, 30, 60, 100, 150, 210, 280])
+OUTCOME_LABELS = ["GOP 280+", "GOP 210-279", "GOP 150-209", "GOP 100-149", "GOP 60-99", "GOP 30-59", "GOP 10-29",
+                  "GOP 0-9", "Dem 1-9", "Dem 10-29", "Dem 30-59", "Dem 60-99", "Dem 100-149", "Dem 150-209",
+                  "Dem 210-279", "Dem 280+"]
+
+
+# Poll quality is stored as a small integer code rather than the "High"/"Low"/"None" strings
+
+QUALITY_CODES = {"High": 0, "Low": 1, "None": 2}
+QUALITY_NAMES = ["High", "Low", "None"]
+HIGH, LOW, NONE = 0, 1, 2
+
+
+# Maine and Nebraska split their electoral votes by congressional district, and are handled by two different
+# rules. For an "average" state, each district is simulated like any other locale and the statewide margin is
+# the average of the districts (their populations being roughly equal). For a "spread" state, the statewide
+# margin is simulated and the two districts are placed either side of it, half of a randomly drawn
+# "districtDiff" above and below (see districtDiffMean on Params). Another split state can be added here
+# without touching the simulation code
+
+SPLIT_STATES = {
+    "NE": ("average", ["NE1", "NE2", "NE3"]),
+    "ME": ("spread", ["ME1", "ME2"]),
+}
+
+
+class Params(object):
+    """Holds the model's hyperparameters, all of which used to be globals in NeoSlim.py or numbers in the loop
+
+    trailingDemMargin is the average margin in recent national polls
+    natMarginEDSTD is the expected standard deviation of the difference between the national polling average
+    when the simulation is run and the national polling margin on Election Day
+    stateMarginEDModifierSTD is the expected standard deviation of the difference between the current polls for
+    a locale and the polls on Election Day, after accounting for the change in the national average
+    avgPolledPollErrorSTD is the standard deviation of the average error in the state polls (3.17, from recent
+    previous elections)
+    nationalPollErrorSTD is the standard deviation of the national poll error on top of the average state poll
+    error (2.22)
+    noPollModifierSTD is the standard deviation of the change in a locale's margin between elections, after
+    adjusting for the national change (5.59, from 2012 to 2016); it is used for locales without polls
+    priorNatMargin is the national Democratic margin of victory in the prior election (2.1 in 2016), which is
+    subtracted from each locale's prior margin
+    districtDiffMean and districtDiffSTD are the mean and standard deviation of the difference in margins between
+    the two districts of a "spread" state. 19.0 was the average for Maine in 2012 and 2016 and 8.7 the standard
+    deviation
+    factorScale multiplies the loadings of the correlated error factors, if the LocaleTable has any (see
+    LocaleTable.loadings); 1 uses them as they are and 0 turns them off
+    """
+
+    FIELDS = ["trailingDemMargin", "natMarginEDSTD", "stateMarginEDModifierSTD", "avgPolledPollErrorSTD",
+              "nationalPollErrorSTD", "noPollModifierSTD", "priorNatMargin", "districtDiffMean", "districtDiffSTD",
+              "factorScale"]
+
+    def __init__(self, trailingDemMargin=6.33, natMarginEDSTD=2.5, stateMarginEDModifierSTD=4,
+                 avgPolledPollErrorSTD=3.17, nationalPollErrorSTD=2.22, noPollModifierSTD=5.59, priorNatMargin=2.1,
+                 districtDiffMean=19.0, districtDiffSTD=8.7, factorScale=1.0):
+        self.trailingDemMargin = trailingDemMargin
+        self.natMarginEDSTD = natMarginEDSTD
+        self.stateMarginEDModifierSTD = stateMarginEDModifierSTD
+        self.avgPolledPollErrorSTD = avgPolledPollErrorSTD
+        self.nationalPollErrorSTD = nationalPollErrorSTD
+        self.noPollModifierSTD = noPollModifierSTD
+        self.priorNatMargin = priorNatMargin
+        self.districtDiffMean = districtDiffMean
+        self.districtDiffSTD = districtDiffSTD
+        self.factorScale = factorScale
+
+    def as_dict(self):
+        return {x: getattr(self, x) for x in self.FIELDS}
+
+    def replace(self, **changes):
+        """Returns a copy of these Params with some of the values changed"""
+
+        values = self.as_dict()
+        values.update(changes)
+        return Params(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, Params) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return "Params(" + ", ".join(x + "=" + repr(getattr(self, x)) for x in self.FIELDS) + ")"
+
+
+class LocaleTable(object):
+    """Holds the characteristics of every state or district ("locale") as one array per field
+
+    All margins are assumed to be Democratic % - Republican %
+    I chose this semi-arbitrarily, on the basis that Biden was leading in most polls, so using positive
+    Democratic margins would reduce the likelihood of an error caused by a missing "-"
+
+    This replaces the list of locale objects NeoSlim used to keep. Each field is a single typed array with one
+    entry per locale, so the simulation code can use the arrays directly without copying them out of objects,
+    and nothing simulated is ever written back here; per-simulation margins live only in the margin matrix and
+    the aggregates only in Results. Everything that used to involve comparing abbreviations inside the
+    simulation loop is also worked out once here, so drawing a simulation involves no string comparisons or
+    searches
+
+    abbrs is the list of locale abbreviations and index maps each abbreviation to its column
+    quality is a subjective assessment of the quality of polls available, if any, as a uint8 code (HIGH, LOW or
+    NONE)
+    polls is the current average margin in the available polls MINUS the average national polling margin
+    priors is the margin in 2016
+    evs is the value in electoral votes, as int16
+    actualDemMargin is the actual margin of victory, where known (NaN otherwise)
+    high, low and none are the columns simulated by each of the three poll quality rules. Locales whose margins
+    are derived from other locales (Nebraska statewide, Maine's districts) are left out of all three
+    isDistrict marks the congressional districts, which are excluded from the smallest margin statistic
+    averageStates holds the columns of the "average" split states and averageWeights the matrix which turns a
+    row of margins into their statewide margins
+    spreadStates is a list of (state, upper district, lower district) for the "spread" split states
+    factors names the correlated error factors, if any, and loadings is a (factors x locales) array of how many
+    points each factor moves each locale's margin by when it is one standard deviation from zero. Locales with
+    loadings on the same factor move together, so that, for instance, a polling miss in WI tends to come with
+    one in MI and PA. By default there are no factors, and the only error shared between locales is the
+    national one
+    """
+
+    def __init__(self, abbrs, pollQuality, polls, priors, evs, splitStates=SPLIT_STATES):
+        self.abbrs = list(abbrs)
+        self.index = {abbr: x for x, abbr in enumerate(self.abbrs)}
+        self.quality = np.array([QUALITY_CODES[x] for x in pollQuality], dtype=np.uint8)
+        self.polls = np.asarray(polls, dtype=np.float64)
+        self.priors = np.asarray(priors, dtype=np.float64)
+        self.evs = np.asarray(evs, dtype=np.int16)
+        self.actualDemMargin = np.full(len(self.abbrs), np.nan)
+
+        numLocales = len(self.abbrs)
+        derived = np.zeros(numLocales, dtype=bool)
+        self.isDistrict = np.zeros(numLocales, dtype=bool)
+        averageStates = []
+        averageWeights = []
+        self.spreadStates = []
+
+        for state, rule in splitStates.items():
+            stateIndex = self.index[state]
+            districts = [self.index[x] for x in rule[1]]
+            self.isDistrict[districts] = True
+
+            if rule[0] == "average":
+                derived[stateIndex] = True
+                weights = np.zeros(numLocales)
+                weights[districts] = 1 / len(districts)
+                averageStates.append(stateIndex)
+                averageWeights.append(weights)
+            elif rule[0] == "spread":
+                derived[districts] = True
+                self.spreadStates.append((stateIndex, districts[0], districts[1]))
+            else:
+                raise ValueError("Unknown split state rule " + repr(rule[0]) + " for " + state)
+
+        self.averageStates = np.array(averageStates, dtype=np.int64)
+        self.averageWeights = np.array(averageWeights).reshape(len(averageStates), numLocales)
+
+        self.high = np.flatnonzero((self.quality == HIGH) & ~derived)
+        self.low = np.flatnonzero((self.quality == LOW) & ~derived)
+        self.none = np.flatnonzero((self.quality == NONE) & ~derived)
+        self.derived = derived
+
+        self.factors = []
+        self.loadings = np.zeros((0, numLocales))
+
+    def set_loadings(self, factors, loadings):
+        """Sets the correlated error factors and their (factors x locales) loadings, in points
+
+        The loadings of split state columns whose margins are derived from other locales are ignored, as their
+        margins follow from the columns they are derived from
+        """
+
+        loadings = np.array(loadings, dtype=np.float64).reshape(len(factors), len(self.abbrs))
+        loadings[:, self.derived] = 0
+        self.factors = list(factors)
+        self.loadings = loadings
+
+    def dependents(self, columns):
+        """Returns the given locale columns plus every split state column whose margin is derived from them"""
+
+        columns = set(int(x) for x in columns)
+        for state, weights in zip(self.averageStates, self.averageWeights):
+            if columns.intersection(np.flatnonzero(weights)):
+                columns.add(int(state))
+        for state, upper, lower in self.spreadStates:
+            if state in columns:
+                columns.update([upper, lower])
+        return np.array(sorted(columns), dtype=np.int64)
+
+    def view(self, results=None):
+        """Returns a list of read-only LocaleView objects, one per locale, for reporting"""
+
+        return [LocaleView(self, results, x) for x in range(len(self.abbrs))]
+
+
+class LocaleView(object):
+    """A read-only view of a single locale in a LocaleTable, along with its results if there are any
+
+    It has the same attribute names as the old locale objects, so reporting code can sort and print locales as
+    it always has, but every attribute is read straight from the underlying arrays and none can be assigned
+
+    demWins is the percentage of simulations in which Biden won the locale
+    demAvg is the average margin of victory across all simulations for the locale
+    tip is the likelihood that the locale would be the tipping point in the Electoral College
+    sm is the likelihood that the state would have the smallest margin of victory (districts excluded)
+    """
+
+    __slots__ = ("_table", "_results", "_x")
+
+    def __init__(self, table, results, x):
+        self._table = table
+        self._results = results
+        self._x = x
+
+    @property
+    def abbr(self):
+        return self._table.abbrs[self._x]
+
+    @property
+    def pollQuality(self):
+        return QUALITY_NAMES[self._table.quality[self._x]]
+
+    @property
+    def polls(self):
+        return float(self._table.polls[self._x])
+
+    @property
+    def prior(self):
+        return float(self._table.priors[self._x])
+
+    @property
+    def evs(self):
+        return int(self._table.evs[self._x])
+
+    @property
+    def actual_dem_margin(self):
+        return float(self._table.actualDemMargin[self._x])
+
+    @property
+    def demWins(self):
+        return float(self._results.localeDemWins[self._x])
+
+    @property
+    def demAvg(self):
+        return float(self._results.localeDemAvg[self._x])
+
+    @property
+    def tip(self):
+        return float(self._results.localeTip[self._x])
+
+    @property
+    def sm(self):
+        return float(self._results.localeSm[self._x])
+
+
+class Results(object):
+    """Holds the statistics produced by a batch of simulations
+
+    All percentages are on a 0-100 scale, matching the numbers NeoSlim has always printed
+
+    abbrs is the list of locale abbreviations, in the order used by the per-locale arrays below
+    nSims is the number of simulations run
+    demWins, GOPWins and ties are the percentages of simulations won by each party or tied
+    avgDemEVs and avgGOPEVs are the average number of electoral votes won by each party
+    PVWinnerLoses is the percentage of simulations in which the popular vote winner lost the Electoral College
+    outcomes is the percentage of simulations falling in each of the 16 PredictIt Electoral College margin bins
+    localeDemWins is the percentage of simulations in which Biden won each locale
+    localeDemAvg is the average Democratic margin in each locale
+    localeTip is the percentage of simulations in which each locale was the tipping point
+    localeSm is the percentage of simulations in which each state had the smallest margin
+    (localeTip and localeSm are None if the run skipped them)
+
+    demWinsSE, avgDemEVsSE, localeDemWinsSE and localeDemAvgSE are the Monte Carlo standard errors of the
+    matching figures, where they were worked out
+    """
+
+    def __init__(self, abbrs, nSims, demWins, GOPWins, ties, avgDemEVs, avgGOPEVs, PVWinnerLoses, outcomes,
+                 localeDemWins, localeDemAvg, localeTip, localeSm, demWinsSE=None, avgDemEVsSE=None,
+                 localeDemWinsSE=None, localeDemAvgSE=None):
+        self.abbrs = abbrs
+        self.nSims = nSims
+        self.demWins = demWins
+        self.GOPWins = GOPWins
+        self.ties = ties
+        self.avgDemEVs = avgDemEVs
+        self.avgGOPEVs = avgGOPEVs
+        self.PVWinnerLoses = PVWinnerLoses
+        self.outcomes = outcomes
+        self.localeDemWins = localeDemWins
+        self.localeDemAvg = localeDemAvg
+        self.localeTip = localeTip
+        self.localeSm = localeSm
+        self.demWinsSE = demWinsSE
+        self.avgDemEVsSE = avgDemEVsSE
+        self.localeDemWinsSE = localeDemWinsSE
+        self.localeDemAvgSE = localeDemAvgSE
+
+
+def percentage_se(percentage, nSims):
+    """Returns the standard error of a percentage estimated from nSims independent simulations"""
+
+    p = np.asarray(percentage) / 100
+    return 100 * np.sqrt(p * (1 - p) / nSims)
+
+
+class Draws(object):
+    """Holds the standard normal random draws behind a batch of simulations
+
+    Keeping the draws separate from the margins they produce means the same draws can be turned into margins
+    again with different inputs (common random numbers), so that the difference between two runs is down to
+    the inputs alone and not Monte Carlo noise
+
+    natMarginED, avgPolledPollError and nationalExtra are (nSims x 1) columns of the shared national draws
+    modifier is an (nSims x locales) array of the draws for each locale's "stateMarginEDModifier"
+    localeError is an (nSims x locales) array of the draws which scale avgPolledPollError in each locale
+    districtDiff is an (nSims x spread states) array of the draws for each spread state's districtDiff
+    factors is an (nSims x factors) array of the draws for each correlated error factor
+    """
+
+    def __init__(self, natMarginED, avgPolledPollError, nationalExtra, modifier, localeError, districtDiff,
+                 factors=None):
+        self.natMarginED = natMarginED
+        self.avgPolledPollError = avgPolledPollError
+        self.nationalExtra = nationalExtra
+        self.modifier = modifier
+        self.localeError = localeError
+        self.districtDiff = districtDiff
+        if factors is None:
+            factors = np.zeros((len(natMarginED), 0))
+        self.factors = factors
+
+    def __len__(self):
+        return len(self.natMarginED)
+
+
+def draw_normals(rng, nSims, table):
+    """Draws the standard normals for nSims simulations of the locales in a LocaleTable"""
+
+    numLocales = len(table.abbrs)
+    natMarginED = rng.standard_normal((nSims, 1))
+    avgPolledPollError = rng.standard_normal((nSims, 1))
+    nationalExtra = rng.standard_normal((nSims, 1))
+
+    # Only the columns that use each kind of draw are filled in; the rest are left at zero, which saves drawing
+    # (for instance) a locale error for every locale without polls
+
+    modifierColumns = np.union1d(table.high, table.none)
+    modifier = np.zeros((nSims, numLocales))
+    modifier[:, modifierColumns] = rng.standard_normal((nSims, len(modifierColumns)))
+
+    errorColumns = np.union1d(table.high, table.low)
+    localeError = np.zeros((nSims, numLocales))
+    localeError[:, errorColumns] = rng.standard_normal((nSims, len(errorColumns)))
+
+    return Draws(
+        natMarginED=natMarginED,
+        avgPolledPollError=avgPolledPollError,
+        nationalExtra=nationalExtra,
+        modifier=modifier,
+        localeError=localeError,
+        districtDiff=rng.standard_normal((nSims, len(table.spreadStates))),
+        factors=rng.standard_normal((nSims, len(table.factors))))
+
+
+def compute_margins(draws, table, params, columns=None, margins=None):
+    """Turns a set of Draws into the Democratic margin in every locale, using the hyperparameters in params
+
+    Returns a tuple of (margins, natMarginED, avgNationalPollError), where margins is an (nSims x locales)
+    array and the other two are the shared national draws for each simulation
+
+    If columns is given, only those locales (and any split states which depend on them) are recomputed, and the
+    rest of the margins array passed in is left as it was
+    """
+
+    nSims = len(draws)
+
+    # The shared national draws are exactly as before: "natMarginED" is the polling margin on Election Day,
+    # "avgPolledPollError" is the average error in the state polls and "avgNationalPollError" the average error
+    # in the national polls. They are column vectors so they broadcast across every locale in a simulation
+
+    natMarginED = params.trailingDemMargin + params.natMarginEDSTD * draws.natMarginED
+    avgPolledPollError = params.avgPolledPollErrorSTD * draws.avgPolledPollError
+    avgNationalPollError = avgPolledPollError + params.nationalPollErrorSTD * draws.nationalExtra
+
+    if margins is None:
+        margins = np.zeros((nSims, len(table.abbrs)))
+
+    high, low, none = table.high, table.low, table.none
+    averageStates, spreadStates = table.averageStates, range(len(table.spreadStates))
+    if columns is not None:
+        columns = table.dependents(columns)
+        high, low, none = [np.intersect1d(x, columns) for x in (high, low, none)]
+        averageStates = np.intersect1d(averageStates, columns)
+        spreadStates = [x for x in spreadStates if table.spreadStates[x][0] in columns]
+
+    # The three branches of the old loop become precomputed column sets
+
+    stateMarginEDModifier = params.stateMarginEDModifierSTD * draws.modifier[:, high]
+    stateMarginED = natMarginED + table.polls[high] + stateMarginEDModifier
+    margins[:, high] = stateMarginED + avgPolledPollError * draws.localeError[:, high]
+
+    # Note that in the original loop the "+ stateMarginEDModifier" for low quality locales ended up on its own
+    # line and was never added to stateMarginED, so the modifier is left out here as well to give the same
+    # results as before
+
+    stateMarginED = natMarginED + 0.5 * table.polls[low] + 0.5 * (table.priors[low] - params.priorNatMargin)
+    margins[:, low] = stateMarginED + avgPolledPollError * draws.localeError[:, low]
+
+    stateMarginEDModifier = params.noPollModifierSTD * draws.modifier[:, none]
+    margins[:, none] = (table.priors[none] - params.priorNatMargin + natMarginED + stateMarginEDModifier
+                        + avgNationalPollError)
+
+    # The correlated errors. Each factor is a single draw per simulation which moves every locale by its loading,
+    # so the correlated errors of every locale in every simulation are one (simulations x factors) by (factors x
+    # locales) matrix multiply
+
+    if len(table.factors) and params.factorScale:
+        with instrument.stage("factors", nSims):
+            simulated = np.concatenate([high, low, none])
+            margins[:, simulated] += params.factorScale * (draws.factors @ table.loadings[:, simulated])
+
+    # The split states are filled in last. Nebraska's statewide margin is the average of its districts, and
+    # Maine's districts are spread either side of its statewide margin
+
+    with instrument.stage("splitStates", nSims):
+        if len(averageStates):
+            rows = np.flatnonzero(np.isin(table.averageStates, averageStates))
+            margins[:, table.averageStates[rows]] = margins @ table.averageWeights[rows].T
+
+        for x in spreadStates:
+            state, upper, lower = table.spreadStates[x]
+            districtDiff = params.districtDiffMean + params.districtDiffSTD * draws.districtDiff[:, x]
+            margins[:, upper] = margins[:, state] + districtDiff / 2
+            margins[:, lower] = margins[:, state] - districtDiff / 2
+
+    return margins, natMarginED[:, 0], avgNationalPollError[:, 0]
+
+
+def loadings_from_covariance(covariance, rank=None):
+    """Returns factor loadings which reproduce a (locales x locales) covariance matrix of locale errors
+
+    With rank=None the loadings are the transposed Cholesky factor, one factor per locale, which reproduce the
+    covariance exactly (it must be positive definite). Otherwise they are the rank largest principal components,
+    the best low-rank approximation, which are cheaper to draw when only a few directions matter
+    """
+
+    covariance = np.asarray(covariance, dtype=np.float64)
+    if rank is None:
+        return np.linalg.cholesky(covariance).T
+
+    values, vectors = np.linalg.eigh(covariance)
+    top = np.argsort(values)[::-1][:rank]
+    return (vectors[:, top] * np.sqrt(np.maximum(values[top], 0))).T
+
+
+def draw_margins(rng, nSims, table, params):
+    """Draws nSims simulated Election Days and returns the Democratic margin in every locale
+
+    Returns the same tuple as compute_margins
+    """
+
+    draws = draw_normals(rng, nSims, table)
+    return compute_margins(draws, table, params)
+
+
+def find_tipping_points(margins, evs, demEVs, GOPEVs, candidates=16):
+    """Returns the index of the tipping point locale in each simulation
+
+    The tipping point is the locale which gave the winner their 270th electoral vote when the locales are
+    ordered from the winner's best to worst margin. Nothing is sorted here apart from a handful of candidates,
+    and the margins are left untouched
+    """
+
+    nSims, numLocales = margins.shape
+    rows = np.arange(nSims)
+
+    # Counting down from the winner's best locale until they reach 270 is the same as counting up from their
+    # worst locale until the EVs passed exceed their "surplus" over 270. Since the winner carried more than 270
+    # EVs, the tipping point is always one of the locales they won, and in practice one of the closest ones
+
+    demWin = demEVs > GOPEVs
+    surplus = np.maximum(demEVs, GOPEVs) - 270
+    won = demWin[:, None] == (margins > 0)
+    key = np.where(won, np.abs(margins), np.inf)
+
+    # argpartition pulls out the winner's "candidates" closest locales in linear time, and only those few are
+    # sorted. The 16 closest locales cover the surplus in all but a few hundredths of a percent of simulations;
+    # those are sent through a full sort of their row instead
+
+    candidates = min(candidates, numLocales)
+    closest = np.argpartition(key, candidates - 1, axis=1)[:, :candidates]
+    closest = np.take_along_axis(closest, np.argsort(np.take_along_axis(key, closest, axis=1), axis=1), axis=1)
+
+    cumEVs = np.cumsum(np.where(np.isfinite(np.take_along_axis(key, closest, axis=1)), evs[closest], 0), axis=1)
+    tips = closest[rows, np.argmax(cumEVs > surplus[:, None], axis=1)]
+
+    missed = cumEVs[:, -1] <= surplus
+    if missed.any():
+        order = np.argsort(key[missed], axis=1)
+        fullEVs = np.cumsum(np.where(np.isfinite(np.take_along_axis(key[missed], order, axis=1)), evs[order], 0),
+                            axis=1)
+        tips[missed] = order[np.arange(len(order)), np.argmax(fullEVs > surplus[missed, None], axis=1)]
+
+    # The old loop never advanced through the list on a 269-269 tie, so the tip went to the last locale of the
+    # ascending sort, i.e. the one with the largest Democratic margin. That is kept for consistency
+
+    tied = demEVs == GOPEVs
+    tips[tied] = np.argmax(margins[tied], axis=1)
+
+    return tips
+
+
+def find_smallest_margins(margins, isDistrict):
+    """Returns the index of the state with the smallest absolute margin in each simulation
+
+    Districts are given an infinite margin so that they are never picked. This is a single pass over each row
+    and, unlike the old loop, leaves the signed margins alone
+    """
+
+    return np.argmin(np.where(isDistrict, np.inf, np.abs(margins)), axis=1)
+
+
+class Tally(object):
+    """Keeps running sums and counts over any number of chunks of simulations
+
+    Unlike Results, nothing here is a percentage: every attribute is a plain count or sum, so tallies from
+    different chunks can simply be added together and only turned into percentages at the end. The memory used
+    depends only on the number of locales, not on the number of simulations
+
+    table is the LocaleTable being simulated
+    tips is whether the tipping point and smallest margin are tallied; if not, localeTip and localeSm stay at zero
+    and are reported as None
+    nSims is the number of simulations tallied so far
+    demWins, GOPWins and ties are the number of simulations won by each party or tied
+    demEVs and GOPEVs are the total electoral votes won by each party across all simulations
+    demEVsSq is the sum of the squares of the Democratic electoral votes, for the standard error of the average
+    PVWinnerLoses is the number of simulations in which the popular vote winner lost the Electoral College
+    outcomes is the number of simulations in each of the 16 Electoral College margin bins
+    localeDemWins is the number of simulations in which Biden won each locale
+    localeMarginSum is the sum of the Democratic margins in each locale and localeMarginSumSq the sum of their
+    squares
+    localeTip and localeSm are the number of times each locale was the tipping point or had the smallest margin
+    """
+
+    def __init__(self, table, tips=True):
+        numLocales = len(table.abbrs)
+        self.table = table
+        self.tips = tips
+        self.nSims = 0
+        self.demWins = 0
+        self.GOPWins = 0
+        self.ties = 0
+        self.demEVs = 0
+        self.GOPEVs = 0
+        self.demEVsSq = 0
+        self.PVWinnerLoses = 0
+        self.outcomes = np.zeros(16, dtype=np.int64)
+        self.localeDemWins = np.zeros(numLocales, dtype=np.int64)
+        self.localeMarginSum = np.zeros(numLocales)
+        self.localeMarginSumSq = np.zeros(numLocales)
+        self.localeTip = np.zeros(numLocales, dtype=np.int64)
+        self.localeSm = np.zeros(numLocales, dtype=np.int64)
+
+    def add(self, margins, natMarginED, avgNationalPollError, demEVs=None):
+        """Adds a chunk of simulated margins, as returned by draw_margins, to the running totals
+
+        demEVs can be passed in if the Democratic EVs of each simulation are already known
+        """
+
+        nSims, numLocales = margins.shape
+        evs = self.table.evs
+
+        # A locale is won by Biden if his margin is positive, so the EVs for each party fall out of a single
+        # matrix-vector product
+
+        with instrument.stage("evs", nSims):
+            demWon = margins > 0
+            if demEVs is None:
+                demEVs = demWon @ evs
+        GOPEVs = evs.sum() - demEVs
+
+        popMargin = natMarginED + avgNationalPollError
+        PVWinnerLoses = ((popMargin > 0) & (GOPEVs > demEVs)) | ((popMargin < 0) & (GOPEVs < demEVs))
+
+        self.nSims += nSims
+        self.demWins += int(np.count_nonzero(demEVs > GOPEVs))
+        self.GOPWins += int(np.count_nonzero(GOPEVs > demEVs))
+        self.ties += int(np.count_nonzero(demEVs == GOPEVs))
+        self.demEVs += int(demEVs.sum())
+        self.GOPEVs += int(GOPEVs.sum())
+        self.demEVsSq += int((demEVs.astype(np.int64) ** 2).sum())
+        self.PVWinnerLoses += int(np.count_nonzero(PVWinnerLoses))
+        self.outcomes += np.bincount(np.searchsorted(OUTCOME_EDGES, demEVs - GOPEVs, side="right"), minlength=16)
+        self.localeDemWins += demWon.sum(axis=0)
+        self.localeMarginSum += margins.sum(axis=0)
+        self.localeMarginSumSq += (margins ** 2).sum(axis=0)
+
+        # Finding the tipping points is the most expensive part of the tally, so it can be skipped when only
+        # the national figures are wanted
+
+        if self.tips:
+            with instrument.stage("tips", nSims):
+                tips = find_tipping_points(margins, evs, demEVs, GOPEVs)
+            with instrument.stage("smallestMargins", nSims):
+                sms = find_smallest_margins(margins, self.table.isDistrict)
+            self.localeTip += np.bincount(tips, minlength=numLocales)
+            self.localeSm += np.bincount(sms, minlength=numLocales)
+
+    def merge(self, other):
+        """Adds the running totals of another Tally over the same locales to this one"""
+
+        self.nSims += other.nSims
+        self.demWins += other.demWins
+        self.GOPWins += other.GOPWins
+        self.ties += other.ties
+        self.demEVs += other.demEVs
+        self.GOPEVs += other.GOPEVs
+        self.demEVsSq += other.demEVsSq
+        self.PVWinnerLoses += other.PVWinnerLoses
+        self.outcomes += other.outcomes
+        self.localeDemWins += other.localeDemWins
+        self.localeMarginSum += other.localeMarginSum
+        self.localeMarginSumSq += other.localeMarginSumSq
+        self.localeTip += other.localeTip
+        self.localeSm += other.localeSm
+
+    def results(self):
+        """Converts the running totals into a Results object of percentages and averages"""
+
+        nSims = self.nSims
+        if nSims <= 0:
+            raise ValueError("there are no simulations to tally")
+
+        # The standard errors of the averages come from the variance, worked out from the sums of squares
+
+        avgDemEVs = self.demEVs / nSims
+        demEVsVar = max(self.demEVsSq / nSims - avgDemEVs ** 2, 0)
+        localeDemAvg = self.localeMarginSum / nSims
+        localeMarginVar = np.maximum(self.localeMarginSumSq / nSims - localeDemAvg ** 2, 0)
+
+        return Results(
+            abbrs=self.table.abbrs,
+            nSims=nSims,
+            demWins=100 * self.demWins / nSims,
+            GOPWins=100 * self.GOPWins / nSims,
+            ties=100 * self.ties / nSims,
+            avgDemEVs=avgDemEVs,
+            avgGOPEVs=self.GOPEVs / nSims,
+            PVWinnerLoses=100 * self.PVWinnerLoses / nSims,
+            outcomes=100 * self.outcomes / nSims,
+            localeDemWins=100 * self.localeDemWins / nSims,
+            localeDemAvg=localeDemAvg,
+            localeTip=100 * self.localeTip / nSims if self.tips else None,
+            localeSm=100 * self.localeSm / nSims if self.tips else None,
+            demWinsSE=float(percentage_se(100 * self.demWins / nSims, nSims)),
+            avgDemEVsSE=np.sqrt(demEVsVar / nSims),
+            localeDemWinsSE=percentage_se(100 * self.localeDemWins / nSims, nSims),
+            localeDemAvgSE=np.sqrt(localeMarginVar / nSims),
+        )
+
+
+def run_chunk(chunkSeed, chunkSims, table, paramSets, tips=True):
+    """Simulates a single chunk from its own seed and returns a Tally for each set of Params
+
+    The random draws are made once and shared by every set of Params. This is what each worker process runs in
+    parallel mode, and it is a top-level function so that it can be pickled and sent to the workers
+    """
+
+    with instrument.stage("draws", chunkSims):
+        draws = draw_normals(np.random.default_rng(chunkSeed), chunkSims, table)
+    tallies = []
+    for params in paramSets:
+        tally = Tally(table, tips)
+        with instrument.stage("margins", chunkSims):
+            margins = compute_margins(draws, table, params)
+        with instrument.stage("tally", chunkSims):
+            tally.add(*margins)
+        tallies.append(tally)
+    return tallies
+
+
+def map_chunks(function, table, args, n_sims, chunk_size, seed, workers):
+    """Yields function(chunkSeed, chunkSims, table, *args) for each chunk of simulations, in chunk order
+
+    Every chunk gets its own random stream, spawned from a master seed. Chunk k's stream doesn't depend on the
+    number of chunks, so stopping early gives exactly the first chunks of a longer run, and any function given the
+    same seed sees the same draws. If the generator is closed early, any chunks the workers haven't started are
+    cancelled. function must be a top-level function so that it can be sent to the workers
+    """
+
+    if n_sims <= 0 or chunk_size <= 0:
+        raise ValueError("n_sims and chunk_size should be positive, not %r and %r" % (n_sims, chunk_size))
+
+    chunkSizes = [min(chunk_size, n_sims - start) for start in range(0, n_sims, chunk_size)]
+    chunkSeeds = np.random.SeedSequence(seed).spawn(len(chunkSizes))
+
+    chunkArgs = [(chunkSeeds[x], chunkSizes[x], table) + tuple(args) for x in range(len(chunkSizes))]
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1:
+        for arguments in chunkArgs:
+            yield function(*arguments)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+
+        # executor.map hands back the chunks in the order they were submitted, however the work was shared out
+        # between the workers, which is what keeps the floating point margin sums reproducible
+
+        batch = max(1, len(chunkArgs) // (4 * workers))
+        for chunk in pool.map(function, *zip(*chunkArgs), chunksize=batch):
+            yield chunk
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def chunk_tallies(table, paramSets, n_sims, chunk_size, seed, workers, tips):
+    """Yields the list of Tallies for each chunk of simulations, in chunk order"""
+
+    return map_chunks(run_chunk, table, (paramSets, tips), n_sims, chunk_size, seed, workers)
+
+
+def run_many(table, paramSets, n_sims=100000, chunk_size=10000, seed=None, workers=1, tips=True):
+    """Runs n_sims simulations of Election Day for each of a list of Params and returns a list of Results
+
+    The simulations are drawn chunk_size at a time and only the running totals in a Tally are kept between
+    chunks, so memory use is bounded by chunk_size rather than n_sims. Every set of Params is applied to the
+    same random draws, which are only drawn once, so differences between them aren't blurred by Monte Carlo
+    noise. tips=False skips the tipping point and smallest margin statistics, which is noticeably faster
+
+    The chunk tallies are always merged in chunk order, so a given seed gives bit-identical results whether
+    the chunks are run in this process (workers=1) or split across a pool of worker processes. workers=None
+    uses one process per CPU
+    """
+
+    tallies = [Tally(table, tips) for params in paramSets]
+
+    for chunk in chunk_tallies(table, paramSets, n_sims, chunk_size, seed, workers, tips):
+        for tally, chunkTally in zip(tallies, chunk):
+            tally.merge(chunkTally)
+
+    return [x.results() for x in tallies]
+
+
+def stream(table, params, n_sims=100000, chunk_size=10000, report_every=10000, seed=None, workers=1,
+           target_se=None, min_sims=10000):
+    """Runs simulations like run, but yields a Results object of the running totals as it goes
+
+    A Results object is yielded every report_every simulations (rounded up to whole chunks), with standard
+    errors filled in so the estimates can be watched as they settle. If target_se is given, the run stops
+    early once the standard error of the Democratic win % is below target_se percentage points, after at least
+    min_sims simulations. Either way, the last Results yielded covers every simulation that was run
+    """
+
+    tally = Tally(table)
+    lastReport = 0
+
+    chunks = chunk_tallies(table, [params], n_sims, chunk_size, seed, workers, True)
+    try:
+        for chunk in chunks:
+            tally.merge(chunk[0])
+            done = tally.nSims == n_sims
+
+            converged = False
+            if target_se is not None and tally.nSims >= min_sims:
+                converged = percentage_se(100 * tally.demWins / tally.nSims, tally.nSims) < target_se
+
+            if done or converged or tally.nSims - lastReport >= report_every:
+                lastReport = tally.nSims
+                yield tally.results()
+            if converged:
+                break
+    finally:
+        chunks.close()
+
+
+def run(table, params, n_sims=100000, chunk_size=10000, seed=None, workers=1):
+    """Runs n_sims simulations of Election Day with one set of Params and returns a Results object
+
+    See run_many for how the simulations are chunked, seeded and shared between workers
+    """
+
+    return run_many(table, [params], n_sims, chunk_size, seed, workers)[0]
@@ -0,0 +1,160 @@
+import copy
+
+import numpy as np
+
+import engine
+
+# Poll averages are refreshed several times a day, but usually only a few states change. Rather than rerunning
+# every simulation from scratch, a Simulation keeps the random draws, margins and EV totals of its last run.
+# When some polls change, only those locales' margins (and the split states that depend on them) are
+# recomputed from the same draws, and the EV totals are adjusted by the EVs of the locales that changed hands.
+# Because the draws are the same, the difference between two runs is due to the new polls alone, with no Monte
+# Carlo noise
+
+
+class Simulation(object):
+    """A full set of simulations held in memory so that poll updates can be re-simulated incrementally
+
+    table is the Simulation's own copy of the LocaleTable, whose polls are kept up to date by update_polls
+    params is the engine.Params the margins were computed with
+    draws is the Draws object behind every simulation
+    margins, natMarginED and avgNationalPollError are as returned by engine.compute_margins
+    demEVs is the number of Democratic electoral votes in each simulation
+    chunkSize is how many simulations are tallied at once when producing results
+    """
+
+    def __init__(self, table, params, n_sims=100000, seed=None, draws=None, chunk_size=10000):
+        self.table = copy.copy(table)
+        self.table.polls = table.polls.copy()
+        self.params = params
+        self.chunkSize = chunk_size
+
+        if draws is None:
+            draws = engine.draw_normals(np.random.default_rng(seed), n_sims, self.table)
+        self.draws = draws
+
+        self.margins, self.natMarginED, self.avgNationalPollError = engine.compute_margins(draws, self.table,
+                                                                                          self.params)
+        self.demEVs = (self.margins > 0) @ self.table.evs.astype(np.int64)
+
+    def results(self):
+        """Tallies the current margins into a Results object"""
+
+        tally = engine.Tally(self.table)
+        for start in range(0, len(self.draws), self.chunkSize):
+            rows = slice(start, start + self.chunkSize)
+            tally.add(self.margins[rows], self.natMarginED[rows], self.avgNationalPollError[rows],
+                      self.demEVs[rows])
+        return tally.results()
+
+    def update_polls(self, polls):
+        """Updates the polling margins of some locales and re-simulates only what they affect
+
+        polls is a dict mapping abbreviations to their new polling margins (relative to the national polls, as
+        in locales.csv). Returns the new Results. Note that locales with no polling data ignore their polls
+        """
+
+        columns = [self.table.index[x] for x in polls]
+        for abbr, value in polls.items():
+            self.table.polls[self.table.index[abbr]] = value
+
+        self.recompute(columns)
+        return self.results()
+
+    def recompute(self, columns):
+        """Recomputes the margins of the given locale columns and the split states that depend on them"""
+
+        changed = self.table.dependents(columns)
+        wonBefore = self.margins[:, changed] > 0
+
+        engine.compute_margins(self.draws, self.table, self.params, columns=changed, margins=self.margins)
+
+        # Only the locales which changed hands in a simulation move its EV totals
+
+        flipped = (self.margins[:, changed] > 0).astype(np.int64) - wonBefore
+        self.demEVs += flipped @ self.table.evs[changed].astype(np.int64)
+
+    def save(self, path):
+        """Saves the draws, margins and polls to an .npz file so a later process can pick up where this left off"""
+
+        np.savez(
+            path,
+            params=np.array([getattr(self.params, x) for x in engine.Params.FIELDS]),
+            polls=self.table.polls,
+            priors=self.table.priors,
+            quality=self.table.quality,
+            evs=self.table.evs,
+            factorNames=np.array(self.table.factors, dtype=str),
+            loadings=self.table.loadings,
+            natMarginED=self.draws.natMarginED,
+            avgPolledPollError=self.draws.avgPolledPollError,
+            nationalExtra=self.draws.nationalExtra,
+            modifier=self.draws.modifier,
+            localeError=self.draws.localeError,
+            districtDiff=self.draws.districtDiff,
+            factors=self.draws.factors,
+            margins=self.margins,
+            demEVs=self.demEVs)
+
+    @classmethod
+    def load(cls, path, table, params, chunk_size=10000):
+        """Loads a saved Simulation and brings it up to date with the polls in table
+
+        If the model parameters and everything in the table besides the polls are the same as when it was saved,
+        only the locales whose polls differ from the saved ones are recomputed. Otherwise the saved draws are
+        reused but every margin is recomputed. Raises ValueError if the saved draws don't fit the table, e.g. if
+        they were made for a different number of locales or correlated error factors
+        """
+
+        with np.load(path) as saved:
+            draws = engine.Draws(
+                natMarginED=saved["natMarginED"],
+                avgPolledPollError=saved["avgPolledPollError"],
+                nationalExtra=saved["nationalExtra"],
+                modifier=saved["modifier"],
+                localeError=saved["localeError"],
+                districtDiff=saved["districtDiff"],
+                factors=saved["factors"] if "factors" in saved else None)
+            if draws.localeError.shape[1] != len(table.abbrs):
+                raise ValueError("%s has draws for %d locales, but the table has %d"
+                                 % (path, draws.localeError.shape[1], len(table.abbrs)))
+            if draws.factors.shape[1] != len(table.factors):
+                raise ValueError("%s has draws for %d correlated error factors, but the table has %d"
+                                 % (path, draws.factors.shape[1], len(table.factors)))
+
+            if engine.Params(*saved["params"].tolist()) != params or not same_table(saved, table):
+                return cls(table, params, draws=draws, chunk_size=chunk_size)
+
+            # The saved margins are taken as they are, and the simulation is then brought up to date with
+            # whichever polls have changed since
+
+            simulation = cls.__new__(cls)
+            simulation.table = copy.copy(table)
+            simulation.table.polls = saved["polls"].copy()
+            simulation.params = params
+            simulation.chunkSize = chunk_size
+            simulation.draws = draws
+            simulation.margins, simulation.natMarginED, simulation.avgNationalPollError = engine.compute_margins(
+                draws, simulation.table, params, columns=[], margins=saved["margins"])
+            simulation.demEVs = saved["demEVs"]
+
+        changed = np.flatnonzero(simulation.table.polls != table.polls)
+        if len(changed):
+            simulation.table.polls[changed] = table.polls[changed]
+            simulation.recompute(changed)
+
+        return simulation
+
+
+def same_table(saved, table):
+    """Returns whether the priors, poll quality, EVs and correlated error factors saved by Simulation.save match
+    those of table. Saves from before these were stored never match
+    """
+
+    if any(x not in saved for x in ["priors", "quality", "evs", "factorNames", "loadings"]):
+        return False
+    return (np.array_equal(saved["priors"], table.priors)
+            and np.array_equal(saved["quality"], table.quality)
+            and np.array_equal(saved["evs"], table.evs)
+            and saved["factorNames"].tolist() == list(table.factors)
+            and np.array_equal(saved["loadings"], table.loadings))
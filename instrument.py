@@ -0,0 +1,119 @@
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import time
+
+# Timers for the stages of a run, so that it is clear where the time goes: drawing the random numbers, computing
+# the margins, the Nebraska and Maine adjustments, tallying the EVs, finding the tipping points and smallest
+# margins, and so on. Code marks a stage with
+#
+#   with instrument.stage("tips", nSims):
+#       ...
+#
+# which, once timing has been switched on with enable(), adds the time taken, one call and nSims items to the
+# "tips" stage. Stages can nest ("splitStates" is timed inside "margins", for instance), so their times don't
+# add up to the total. Stages are only marked once per chunk of simulations, never per simulation, and when
+# timing is off stage() just hands back a shared do-nothing context, so leaving the marks in costs nothing
+# measurable.
+#
+# Timings are kept in the process which does the work, so time a run with workers=1 to see all of it.
+#
+# profile() wraps a block in cProfile, for a function-by-function breakdown when the stages aren't enough
+
+_NULL = contextlib.nullcontext()
+_timings = None
+
+
+class Timings(object):
+    """Running totals for each stage
+
+    seconds, calls and items map each stage's name to the total time spent in it, the number of times it ran
+    and the number of items (usually simulations) it processed
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.calls = {}
+        self.items = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.items[name] = self.items.get(name, 0) + items
+
+    def report(self):
+        """Returns the timings as a dict, ready to be written out as JSON"""
+
+        stages = {}
+        for name, seconds in sorted(self.seconds.items(), key=lambda x: -x[1]):
+            stages[name] = {
+                "seconds": seconds,
+                "calls": self.calls[name],
+                "items": self.items[name],
+                "itemsPerSecond": self.items[name] / seconds if seconds and self.items[name] else None,
+            }
+        return {"totalSeconds": time.perf_counter() - self.started, "stages": stages}
+
+
+def enable():
+    """Switches timing on, starting from zero, and returns the Timings which will be kept"""
+
+    global _timings
+    _timings = Timings()
+    return _timings
+
+
+def disable():
+    """Switches timing off and returns the Timings kept since enable (None if it wasn't on)"""
+
+    global _timings
+    timings = _timings
+    _timings = None
+    return timings
+
+
+def stage(name, items=0):
+    """Returns a context which times a stage if timing is on, and does nothing if not"""
+
+    if _timings is None:
+        return _NULL
+    return _timings.stage(name, items)
+
+
+def write_report(timings, path, **extra):
+    """Writes a Timings report to a JSON file, along with any extra fields (such as the settings of the run)"""
+
+    report = dict(extra)
+    report.update(timings.report())
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+
+
+@contextlib.contextmanager
+def profile(path=None, top=25):
+    """Runs the block under cProfile
+
+    The statistics are saved to path, for pstats or snakeviz, if one is given, and the top functions by
+    cumulative time are printed otherwise
+    """
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        else:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(top)
+            print(output.getvalue())
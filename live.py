@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import socket
+import time
+
+import numpy as np
+
+import engine
+import loader
+import query
+import store
+
+# Election-night mode. Rather than resimulating as results come in, the draws in a draw store (see store.py) are
+# conditioned on what has been reported so far, and the national odds re-estimated from the draws that remain:
+#
+#   a locale which has been called rules out every draw in which the other party won it (rejection)
+#   a locale which is partly counted reweights the draws by how likely its current margin would be if their
+#   final margin were the true one (importance weighting)
+#
+# Reports arrive as JSON objects, one per line, from a file which is followed as it grows or from a socket
+# standing in for a results feed:
+#
+#   {"abbr": "FL", "called": "GOP"}
+#   {"abbr": "PA", "reported": 0.65, "demMargin": -4.2}
+#
+# "called" is "Dem" or "GOP". "reported" is the fraction of the expected vote counted so far and "demMargin" the
+# Democratic margin in it, in points. A later report for a locale replaces the earlier one. As more of the vote is
+# counted, the final margin is expected to stay closer to the current one: it is taken to differ from it by a
+# normal error with a standard deviation of partialSTD * (1 - reported) points
+
+partialSTD = 10
+
+# The smallest standard deviation used for a partly counted locale, so that a fully counted but uncalled locale
+# still leaves some draws on each side of its margin
+
+minimumSTD = 0.25
+
+
+class LiveModel(object):
+    """The odds given the reports so far, kept up to date as reports arrive
+
+    index is the query.QueryIndex over the draw store
+    reports maps each reported locale's abbreviation to its latest report
+    """
+
+    def __init__(self, index, partial_std=partialSTD):
+        self.index = index
+        self.partialSTD = partial_std
+        self.reports = {}
+
+    def update(self, report):
+        """Records a report (a dict as described above) and returns the new estimate
+
+        Raises a ValueError if the report is malformed, leaving the earlier reports as they were
+        """
+
+        if not isinstance(report, dict):
+            raise ValueError("a report should be a JSON object, not " + repr(report))
+        abbr = report.get("abbr")
+        if abbr not in self.index.store.index:
+            raise ValueError("unknown locale " + repr(abbr))
+        if "called" in report:
+            if report["called"] not in ("Dem", "GOP"):
+                raise ValueError(abbr + " was called for " + repr(report["called"]) + " rather than Dem or GOP")
+        elif "reported" in report and "demMargin" in report:
+            if not 0 < float(report["reported"]) <= 1:
+                raise ValueError(abbr + " has reported " + repr(report["reported"]) + " of its vote")
+            if not np.isfinite(float(report["demMargin"])):
+                raise ValueError(abbr + " has a margin of " + repr(report["demMargin"]))
+        else:
+            raise ValueError(abbr + " has neither a call nor a partial count")
+
+        self.reports[abbr] = report
+        return self.estimate()
+
+    def condition(self):
+        """Returns the Condition that the called locales put on the draws, and the weights from the partial counts
+
+        Either is None if there is nothing to condition on
+        """
+
+        dem = [x for x, report in self.reports.items() if report.get("called") == "Dem"]
+        gop = [x for x, report in self.reports.items() if report.get("called") == "GOP"]
+        given = query.Called(dem=dem, gop=gop) if dem or gop else None
+
+        # The weights are worked out as log-likelihoods, so that many partly counted locales don't underflow
+
+        logWeights = None
+        for abbr, report in self.reports.items():
+            if "called" in report:
+                continue
+            std = max(self.partialSTD * (1 - float(report["reported"])), minimumSTD)
+            z = (float(report["demMargin"]) - self.index.margin(abbr)) / std
+            if logWeights is None:
+                logWeights = np.zeros(self.index.nSims)
+            logWeights -= 0.5 * z ** 2
+
+        # They are scaled so that the likeliest draw which the calls leave has a weight of one. Scaling by the
+        # likeliest draw of all would let partial counts that disagree with the calls underflow every weight that
+        # is left to zero. Draws the calls rule out are capped at one, as their weights are never used
+
+        weights = None
+        if logWeights is not None:
+            remaining = logWeights if given is None else logWeights[given.mask(self.index)]
+            top = remaining.max() if len(remaining) else logWeights.max()
+            weights = np.exp(np.minimum(logWeights - top, 0))
+
+        return given, weights
+
+    def estimate(self):
+        """Returns a query.Conditional of the odds given every report so far"""
+
+        given, weights = self.condition()
+        return self.index.query(given, weights)
+
+
+def follow_file(path, poll=0.5):
+    """Yields the lines of a file, then waits for and yields any more lines written to it"""
+
+    with open(path) as f:
+        buffer = ""
+        while True:
+            line = f.readline()
+            if not line:
+                time.sleep(poll)
+                continue
+            buffer += line
+            if not buffer.endswith("\n"):
+                continue
+            if buffer.strip():
+                yield buffer
+            buffer = ""
+
+
+def serve_socket(host="127.0.0.1", port=8765):
+    """Yields the lines sent to a TCP socket, one connection after another
+
+    This stands in for a real results feed; "nc 127.0.0.1 8765 < reports.jsonl" sends a file of reports
+    """
+
+    with socket.create_server((host, port)) as server:
+        while True:
+            connection, address = server.accept()
+            with connection, connection.makefile() as f:
+                for line in f:
+                    if line.strip():
+                        yield line
+
+
+def print_estimate(model, odds, elapsed):
+    called = sum(1 for x in model.reports.values() if "called" in x)
+    print(len(model.reports), "locales reported,", called, "called", "\t", "Draws left:", odds.nSims,
+          "(effective", str(int(odds.effectiveSims)) + ")", "\t", "Updated in", round(elapsed, 3), "s")
+    if not odds.nSims:
+        print("No simulated draws are consistent with the calls so far")
+        print()
+        return
+    print("Win %:", round(odds.demWins,1), "Democratic,", round(odds.GOPWins,1), "Republican,",
+          round(odds.ties,1), "Ties", "\t", "Average electoral votes:", int(round(odds.avgDemEVs,0)), "Democratic")
+    tips = np.argsort(odds.localeTip)[::-1][:5]
+    print("Likeliest tipping points:", ", ".join(odds.abbrs[x] + " " + str(round(odds.localeTip[x],1)) + "%"
+                                                 for x in tips))
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-estimates the election odds as results are reported")
+    parser.add_argument("store", help="draw store directory; one is simulated there first if it doesn't exist")
+    parser.add_argument("--file", help="file of JSON line reports to follow")
+    parser.add_argument("--port", type=int, help="port to listen for JSON line reports on")
+    parser.add_argument("--sims", type=int, default=1000000, help="simulations when writing a new store")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--partial-std", type=float, default=partialSTD,
+                        help="standard deviation of the uncounted vote's swing, in points, at 0%% counted")
+    args = parser.parse_args(argv)
+
+    if (args.file is None) == (args.port is None):
+        parser.error("give one of --file or --port")
+
+    if os.path.exists(os.path.join(args.store, "meta.json")):
+        draws = store.DrawStore(args.store)
+    else:
+        dataDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "2020")
+        table = loader.load_table(os.path.join(dataDir, "locales.csv"))
+        draws = store.write_store(args.store, table, engine.Params(), n_sims=args.sims, seed=args.seed)
+
+    model = LiveModel(query.QueryIndex(draws), args.partial_std)
+    print_estimate(model, model.estimate(), 0)
+
+    lines = follow_file(args.file) if args.file is not None else serve_socket(port=args.port)
+    for line in lines:
+        start = time.perf_counter()
+        try:
+            odds = model.update(json.loads(line))
+        except (TypeError, ValueError) as error:
+            print("Ignoring report", line.strip(), "-", error)
+            continue
+        print_estimate(model, odds, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
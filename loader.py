@@ -0,0 +1,275 @@
+import csv
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+import engine
+
+# Loads the locale inputs from tabular files keyed by abbreviation, checks them, and compiles them into a
+# LocaleTable. The files for each election cycle live in data/<year>/:
+#
+#   locales.csv has one row per locale with the columns abbr, pollQuality, polls, prior and evs, as described on
+#   LocaleTable. Locales without polling data have a pollQuality of "None" and polls of 0
+#   results.csv has the columns abbr and actualDemMargin, the actual Democratic margin in each locale
+#   factors.csv, which is optional, has an abbr column and one column per correlated error factor holding each
+#   locale's loading on it in points (see LocaleTable.loadings). Locales left out don't load on any factor
+#
+# The same columns can also be given as a JSON list of records, or as a Parquet file if pandas is installed.
+# Because the rows are matched up by abbreviation, the order of the rows in each file doesn't matter
+
+LOCALE_COLUMNS = ["abbr", "pollQuality", "polls", "prior", "evs"]
+RESULT_COLUMNS = ["abbr", "actualDemMargin"]
+
+
+# Every locale which casts electoral votes: the 50 states, DC, and the congressional districts of Maine and
+# Nebraska
+
+ALL_LOCALES = ["AK","AL","AR","AZ","CA","CO","CT","DC","DE","FL","GA","HI","IA","ID","IL","IN","KS","KY","LA","MA",
+               "MD","ME","ME1","ME2","MI","MN","MO","MS","MT","NC","ND","NE","NE1","NE2","NE3","NH","NJ","NM",
+               "NV","NY","OH","OK","OR","PA","RI","SC","SD","TN","TX","UT","VA","VT","WA","WI","WV","WY"]
+
+
+# Bumped whenever the layout of the compiled snapshot changes, so that old snapshots are rebuilt
+
+SNAPSHOT_VERSION = 1
+
+
+def read_rows(path):
+    """Reads a CSV, JSON or Parquet file into a list of dicts, one per row"""
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".csv":
+        with open(path, newline="") as f:
+            return list(csv.DictReader(f))
+    elif extension == ".json":
+        with open(path) as f:
+            return json.load(f)
+    elif extension == ".parquet":
+
+        # pandas is only needed for Parquet files, so it is only imported when one is actually read
+
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError("Reading " + path + " needs pandas (and pyarrow) to be installed")
+        return pandas.read_parquet(path).to_dict("records")
+    else:
+        raise ValueError("Don't know how to read " + path + "; expected a .csv, .json or .parquet file")
+
+
+def keyed_rows(path, columns):
+    """Reads a file and returns its rows as a dict keyed by abbreviation, checking the columns and duplicates"""
+
+    problems = []
+    rows = {}
+
+    for number, row in enumerate(read_rows(path)):
+        missing = [x for x in columns if x not in row]
+        if missing:
+            problems.append("row " + str(number + 1) + " is missing " + ", ".join(missing))
+            continue
+        abbr = str(row["abbr"]).strip()
+        if abbr in rows:
+            problems.append(abbr + " appears more than once")
+        rows[abbr] = row
+
+    if problems:
+        raise ValueError(path + ": " + "; ".join(problems))
+
+    return rows
+
+
+def parse_number(row, column, kind, problems):
+    """Returns row[column] as a float or int, adding to problems and returning zero if it isn't one
+
+    NaN and infinite values are rejected, and so are fractional values where an int is wanted, rather than being
+    truncated
+    """
+
+    try:
+        value = float(row[column])
+    except (TypeError, ValueError):
+        value = float("nan")
+    if not np.isfinite(value) or (kind is int and not value.is_integer()):
+        problems.append(str(row["abbr"]) + " has a bad " + column + " value " + repr(row[column]))
+        return kind(0)
+    return kind(value)
+
+
+def build_table(localesPath, resultsPath=None):
+    """Reads and validates the locale (and, optionally, results) files and returns a LocaleTable
+
+    Raises a ValueError listing everything wrong with the files if the EVs don't add up to 538, a locale is
+    missing, duplicated or unknown, or a value can't be read
+    """
+
+    rows = keyed_rows(localesPath, LOCALE_COLUMNS)
+    problems = []
+
+    missing = [x for x in ALL_LOCALES if x not in rows]
+    unknown = [x for x in rows if x not in ALL_LOCALES]
+    if missing:
+        problems.append("missing locales " + ", ".join(missing))
+    if unknown:
+        problems.append("unknown locales " + ", ".join(unknown))
+
+    abbrs = list(rows)
+    pollQuality = [str(rows[x]["pollQuality"]).strip() for x in abbrs]
+    polls = [parse_number(rows[x], "polls", float, problems) for x in abbrs]
+    priors = [parse_number(rows[x], "prior", float, problems) for x in abbrs]
+    evs = [parse_number(rows[x], "evs", int, problems) for x in abbrs]
+
+    for abbr, quality in zip(abbrs, pollQuality):
+        if quality not in engine.QUALITY_CODES:
+            problems.append(abbr + " has an unknown pollQuality " + repr(quality))
+
+    if sum(evs) != 538:
+        problems.append("the electoral votes add up to " + str(sum(evs)) + " rather than 538")
+
+    if problems:
+        raise ValueError(localesPath + ": " + "; ".join(problems))
+
+    table = engine.LocaleTable(abbrs, pollQuality, polls, priors, evs)
+
+    if resultsPath is not None:
+        results = keyed_rows(resultsPath, RESULT_COLUMNS)
+        missing = [x for x in abbrs if x not in results]
+        unknown = [x for x in results if x not in table.index]
+        if missing:
+            problems.append("missing locales " + ", ".join(missing))
+        if unknown:
+            problems.append("unknown locales " + ", ".join(unknown))
+        for abbr in abbrs:
+            if abbr in results:
+                table.actualDemMargin[table.index[abbr]] = parse_number(results[abbr], "actualDemMargin", float,
+                                                                        problems)
+        if problems:
+            raise ValueError(resultsPath + ": " + "; ".join(problems))
+
+    return table
+
+
+def load_factors(path, table):
+    """Reads a file of correlated error factor loadings into a LocaleTable, replacing any it had, and returns it
+
+    Raises a ValueError if a locale is unknown or a loading can't be read
+    """
+
+    rows = keyed_rows(path, ["abbr"])
+    problems = []
+
+    unknown = [x for x in rows if x not in table.index]
+    if unknown:
+        problems.append("unknown locales " + ", ".join(unknown))
+
+    factors = []
+    for row in rows.values():
+        factors.extend(x for x in row if x != "abbr" and x not in factors)
+
+    loadings = np.zeros((len(factors), len(table.abbrs)))
+    for abbr, row in rows.items():
+        if abbr in table.index:
+            for x, factor in enumerate(factors):
+                if row.get(factor) not in (None, ""):
+                    loadings[x, table.index[abbr]] = parse_number(row, factor, float, problems)
+
+    if problems:
+        raise ValueError(path + ": " + "; ".join(problems))
+
+    table.set_loadings(factors, loadings)
+    return table
+
+
+def source_signature(paths):
+    """Identifies the versions of the source files by their size and modification time"""
+
+    return np.array([[os.stat(x).st_size, os.stat(x).st_mtime_ns] for x in paths], dtype=np.int64)
+
+
+def save_snapshot(table, snapshotPath, signature):
+    """Saves a snapshot, if it can, returning whether it did
+
+    The snapshot is written to a temporary file and then renamed into place, so that another process loading the
+    same files never reads a half-written one. A snapshot is only a cache, so if the directory can't be written
+    to the table is simply rebuilt next time
+    """
+
+    directory = os.path.dirname(os.path.abspath(snapshotPath))
+    try:
+        handle, temporaryPath = tempfile.mkstemp(suffix=".npz", dir=directory)
+    except OSError:
+        return False
+
+    try:
+        with os.fdopen(handle, "wb") as f:
+            np.savez(
+                f,
+                version=SNAPSHOT_VERSION,
+                signature=signature,
+                abbrs=np.array(table.abbrs),
+                quality=table.quality,
+                polls=table.polls,
+                priors=table.priors,
+                evs=table.evs,
+                actualDemMargin=table.actualDemMargin)
+        os.replace(temporaryPath, snapshotPath)
+    except OSError:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        return False
+    return True
+
+
+def load_snapshot(snapshotPath, signature):
+    """Returns the LocaleTable stored in a snapshot, or None if it is missing, out of date or unreadable"""
+
+    if not os.path.exists(snapshotPath):
+        return None
+
+    try:
+        with np.load(snapshotPath) as snapshot:
+            if int(snapshot["version"]) != SNAPSHOT_VERSION or not np.array_equal(snapshot["signature"], signature):
+                return None
+
+            table = engine.LocaleTable(
+                [str(x) for x in snapshot["abbrs"]],
+                [engine.QUALITY_NAMES[x] for x in snapshot["quality"]],
+                snapshot["polls"],
+                snapshot["priors"],
+                snapshot["evs"])
+            table.actualDemMargin[:] = snapshot["actualDemMargin"]
+    except (OSError, EOFError, KeyError, IndexError, ValueError, zipfile.BadZipFile):
+        return None
+
+    return table
+
+
+def load_table(localesPath, resultsPath=None, snapshotPath=None):
+    """Returns the LocaleTable for a set of input files, using a compiled snapshot where possible
+
+    The first time the files are loaded they are parsed and validated as in build_table and the table is saved
+    to snapshotPath (by default locales.npz, or locales_results.npz when a results file is loaded too, next to
+    the locales file). After that, as long as none of the files have changed, the table is read straight back
+    from the snapshot without parsing or validating anything. A snapshot which can't be read or written is
+    treated as missing
+    """
+
+    if snapshotPath is None:
+        snapshotPath = os.path.splitext(localesPath)[0]
+        if resultsPath is not None:
+            snapshotPath += "_" + os.path.splitext(os.path.basename(resultsPath))[0]
+        snapshotPath += ".npz"
+
+    paths = [localesPath] if resultsPath is None else [localesPath, resultsPath]
+    signature = source_signature(paths)
+
+    table = load_snapshot(snapshotPath, signature)
+    if table is None:
+        table = build_table(localesPath, resultsPath)
+        save_snapshot(table, snapshotPath, signature)
+
+    return table
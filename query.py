@@ -0,0 +1,265 @@
+import numpy as np
+
+import engine
+
+# Conditional odds over a draw store (see store.py), such as P(Dem wins | Dem wins PA), P(tipping point = WI |
+# GOP wins) or the EV distribution given the states already called on election night:
+#
+#   index = query.QueryIndex(store.DrawStore("draws"))
+#   odds = index.query(query.Called(dem=["PA"], gop=["FL", "NC"]))
+#   odds.demWins, odds.evs, odds.localeTip
+#
+# Conditions are built from the classes below and combined with &, | and ~. Answering them over the stored
+# margins would mean reading every locale's margin in every draw, so a QueryIndex first packs who won each locale
+# into one 64-bit mask per draw and keeps that, with the EVs, popular vote margin and tipping point, in memory.
+# A condition on any number of called locales is then two bitwise operations per draw, and a query over millions
+# of draws takes milliseconds. Only conditions on the size of a locale's margin go back to the store, one locale
+# column at a time, and each column is kept once read
+
+
+class QueryIndex(object):
+    """The in-memory columns of a DrawStore that conditions are evaluated against
+
+    store is the DrawStore being queried
+    demBits has one bit per locale for each draw, set if Biden won it (bit x is locale column x)
+    demEVs, popMargin and tip are the store's columns, read into memory
+    """
+
+    def __init__(self, store):
+        numLocales = len(store.abbrs)
+        if numLocales > 64:
+            raise ValueError("a QueryIndex can only pack up to 64 locales, not " + str(numLocales))
+
+        self.store = store
+        self.nSims = store.nSims
+        self.demBits = np.zeros(store.nSims, dtype="<u8")
+        self.demEVs = np.asarray(store.demEVs, dtype=np.int16).copy()
+        self.popMargin = np.asarray(store.popMargin, dtype=np.float32).copy()
+        self.tip = np.asarray(store.tip, dtype=np.int8).copy()
+        self.margins = {}
+
+        # np.packbits gives the bits for locales 0-7 in the first byte, 8-15 in the second and so on, so padding
+        # each row out to eight bytes and reading it as a little-endian uint64 puts locale x in bit x
+
+        for block in store.blocks():
+            packed = np.zeros((len(block), 8), dtype=np.uint8)
+            packed[:, :(numLocales + 7) // 8] = np.packbits(block.margins > 0, axis=1, bitorder="little")
+            self.demBits[block.rows] = packed.view("<u8")[:, 0]
+
+    def bits(self, abbrs):
+        """Returns the mask with the bits of the given locales set"""
+
+        mask = 0
+        for abbr in abbrs:
+            mask |= 1 << self.store.index[abbr]
+        return np.uint64(mask)
+
+    def margin(self, abbr):
+        """Returns the Democratic margin in a locale in every draw, reading it from the store the first time"""
+
+        if abbr not in self.margins:
+            self.margins[abbr] = np.array(self.store.margins[:, self.store.index[abbr]])
+        return self.margins[abbr]
+
+    def query(self, given=None, weights=None):
+        """Returns a Conditional with the odds over the draws in which the Condition given holds
+
+        weights, if given, weights each draw, as when conditioning on evidence which makes some draws more likely
+        than others rather than ruling them out
+        """
+
+        if given is None:
+            return Conditional(self, np.ones(self.nSims, dtype=bool), weights)
+        return Conditional(self, given.mask(self), weights)
+
+    def probability(self, event, given=None):
+        """Returns the percentage of the draws in which given holds in which event holds too (NaN if none)"""
+
+        condition = np.ones(self.nSims, dtype=bool) if given is None else given.mask(self)
+        total = np.count_nonzero(condition)
+        if not total:
+            return float("nan")
+        return 100 * np.count_nonzero(event.mask(self) & condition) / total
+
+
+class Conditional(object):
+    """The odds over the draws matching a condition, on the same 0-100 scale as engine.Results
+
+    nSims is the number of matching draws and share is the percentage of all the draws that they make up
+    demWins, GOPWins and ties are the percentage of the matching draws won by each party or tied
+    avgDemEVs and avgGOPEVs are the average electoral votes won by each party
+    evs is the percentage of matching draws in which Biden won each number of electoral votes, from 0 to 538
+    outcomes is the percentage in each of the 16 Electoral College margin bins, as in Results
+    localeDemWins is the percentage in which Biden won each locale
+    localeTip is the percentage in which each locale was the tipping point
+    Everything but nSims and share is NaN if no draws match
+
+    If the draws are given weights, every percentage and average is weighted by them, and effectiveSims is the
+    effective number of draws behind the weighted figures (Kish's n = (sum w)^2 / sum w^2), which falls as the
+    weights become more uneven. Unweighted, effectiveSims is just nSims
+    """
+
+    def __init__(self, index, mask, weights=None):
+        numLocales = len(index.store.abbrs)
+        totalEVs = int(index.store.evs.sum())
+
+        self.abbrs = index.store.abbrs
+        self.nSims = int(np.count_nonzero(mask))
+        self.share = 100 * self.nSims / index.nSims
+
+        demEVs = index.demEVs[mask].astype(np.int64)
+        GOPEVs = totalEVs - demEVs
+        demBits = index.demBits[mask]
+        tip = index.tip[mask]
+
+        # Unweighted, the percentages are counts, which are much quicker to take than sums of weights
+
+        if weights is None:
+            self.effectiveSims = self.nSims
+            weigh = np.count_nonzero
+            total = self.nSims if self.nSims else np.nan
+        else:
+            weights = weights[mask]
+            self.effectiveSims = weights.sum() ** 2 / (weights ** 2).sum() if self.nSims else 0.0
+            weigh = lambda x: weights[x].sum()
+            total = weights.sum() if self.nSims else np.nan
+
+        self.demWins = 100 * weigh(demEVs > GOPEVs) / total
+        self.GOPWins = 100 * weigh(GOPEVs > demEVs) / total
+        self.ties = 100 * weigh(demEVs == GOPEVs) / total
+        self.evs = 100 * np.bincount(demEVs, weights, minlength=totalEVs + 1) / total
+        self.avgDemEVs = (self.evs * np.arange(totalEVs + 1)).sum() / 100
+        self.avgGOPEVs = totalEVs - self.avgDemEVs
+        self.outcomes = 100 * np.bincount(np.searchsorted(engine.OUTCOME_EDGES, demEVs - GOPEVs, side="right"),
+                                          weights, minlength=16) / total
+        self.localeDemWins = 100 * np.array([weigh((demBits & np.uint64(1 << x)) != 0)
+                                             for x in range(numLocales)]) / total
+        self.localeTip = 100 * np.bincount(tip, weights, minlength=numLocales) / total
+
+    def ev_range(self, low, high):
+        """Returns the percentage of matching draws in which Biden won from low up to and including high EVs"""
+
+        return float(self.evs[max(low, 0):high + 1].sum())
+
+
+class Condition(object):
+    """Something that is or isn't true of each draw; combine Conditions with &, | and ~"""
+
+    def mask(self, index):
+        """Returns a boolean array saying whether the condition holds in each draw of a QueryIndex"""
+
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class All(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def mask(self, index):
+        mask = self.conditions[0].mask(index)
+        for condition in self.conditions[1:]:
+            mask &= condition.mask(index)
+        return mask
+
+
+class Any(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def mask(self, index):
+        mask = self.conditions[0].mask(index)
+        for condition in self.conditions[1:]:
+            mask |= condition.mask(index)
+        return mask
+
+
+class Not(Condition):
+    def __init__(self, condition):
+        self.condition = condition
+
+    def mask(self, index):
+        return ~self.condition.mask(index)
+
+
+class Called(Condition):
+    """Biden won every locale in dem and Trump won every locale in gop"""
+
+    def __init__(self, dem=(), gop=()):
+        self.dem = list(dem)
+        self.gop = list(gop)
+
+    def mask(self, index):
+        demMask = index.bits(self.dem)
+        return ((index.demBits & demMask) == demMask) & ((index.demBits & index.bits(self.gop)) == 0)
+
+
+class Margin(Condition):
+    """Biden's margin in a locale was at least low and below high"""
+
+    def __init__(self, abbr, low=-np.inf, high=np.inf):
+        self.abbr = abbr
+        self.low = low
+        self.high = high
+
+    def mask(self, index):
+        margin = index.margin(self.abbr)
+        return (margin >= self.low) & (margin < self.high)
+
+
+class NationalMargin(Condition):
+    """Biden's national popular vote margin was at least low and below high"""
+
+    def __init__(self, low=-np.inf, high=np.inf):
+        self.low = low
+        self.high = high
+
+    def mask(self, index):
+        return (index.popMargin >= self.low) & (index.popMargin < self.high)
+
+
+class DemEVs(Condition):
+    """Biden won from low up to and including high electoral votes"""
+
+    def __init__(self, low=0, high=538):
+        self.low = low
+        self.high = high
+
+    def mask(self, index):
+        return (index.demEVs >= self.low) & (index.demEVs <= self.high)
+
+
+class Winner(Condition):
+    """The Electoral College went to party, which is "Dem", "GOP" or "Tie" for a 269-269 tie"""
+
+    def __init__(self, party):
+        if party not in ("Dem", "GOP", "Tie"):
+            raise ValueError("party should be Dem, GOP or Tie, not " + repr(party))
+        self.party = party
+
+    def mask(self, index):
+        demEVs = index.demEVs.astype(np.int64)
+        GOPEVs = int(index.store.evs.sum()) - demEVs
+        if self.party == "Dem":
+            return demEVs > GOPEVs
+        elif self.party == "GOP":
+            return GOPEVs > demEVs
+        return demEVs == GOPEVs
+
+
+class Tip(Condition):
+    """The locale abbr was the tipping point"""
+
+    def __init__(self, abbr):
+        self.abbr = abbr
+
+    def mask(self, index):
+        return index.tip == index.store.index[self.abbr]
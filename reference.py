@@ -0,0 +1,171 @@
+import bisect
+import operator
+import random
+
+import numpy as np
+
+import engine
+
+# The original pure-Python simulation loop from NeoSlim.py, kept as the reference the vectorized engine is
+# benchmarked and checked against (see bench.py). Apart from taking its inputs from a LocaleTable and Params,
+# counting rather than adding 1 / 1000 at a time, binning the outcomes with bisect rather than a chain of ifs,
+# and using its own seeded random.Random, it is the same code, quirks included, so it should not be "improved"
+
+OUTCOME_EDGES = engine.OUTCOME_EDGES.tolist()
+
+
+class referenceLocale(object):
+    """The parts of the original locale class used by the simulation loop"""
+
+    def __init__(self, abbr, pollQuality, polls, prior, evs):
+        self.abbr = abbr
+        self.pollQuality = pollQuality
+        self.polls = polls
+        self.prior = prior
+        self.evs = evs
+        self.demMargin = 0
+        self.demWins = 0
+        self.demAvg = 0
+        self.tip = 0
+        self.sm = 0
+
+
+def run_reference(table, params, n_sims=100000, seed=None):
+    """Runs n_sims simulations one at a time with the original loop and returns a Results object"""
+
+    rng = random.Random(seed)
+    allStates = [referenceLocale(x.abbr, x.pollQuality, x.polls, x.prior, x.evs) for x in table.view()]
+    order = {x.abbr: i for i, x in enumerate(allStates)}
+
+    trailingDemMargin = params.trailingDemMargin
+    natMarginEDSTD = params.natMarginEDSTD
+    stateMarginEDModifierSTD = params.stateMarginEDModifierSTD
+
+    avgDemEVs = 0
+    avgGOPEVs = 0
+    demWins = 0
+    GOPWins = 0
+    ties = 0
+    outcomes = [0] * 16
+    PVWinnerLoses = 0
+
+    for y in range(n_sims):
+        natMarginED = trailingDemMargin + rng.gauss(0, natMarginEDSTD)
+        avgPolledPollError = rng.gauss(0, params.avgPolledPollErrorSTD)
+        avgNationalPollError = avgPolledPollError + rng.gauss(0, params.nationalPollErrorSTD)
+
+        demEVs = 0
+        GOPEVs = 0
+        maineMargin = 0
+
+        for x in range(len(allStates)):
+            allStates[x].demMargin = 0
+
+        for x in range(len(allStates)):
+            if allStates[x].pollQuality == "High":
+                stateMarginEDModifier = rng.gauss(0, stateMarginEDModifierSTD)
+                stateMarginED = natMarginED + allStates[x].polls + stateMarginEDModifier
+                demMargin = stateMarginED + avgPolledPollError * rng.gauss(0, 1)
+                allStates[x].demMargin = demMargin
+
+            elif allStates[x].pollQuality == "Low":
+                stateMarginEDModifier = rng.gauss(0, stateMarginEDModifierSTD)
+
+                # The dangling "+ stateMarginEDModifier" of the original, which was never added
+
+                stateMarginED = natMarginED + 0.5 * allStates[x].polls + 0.5 * (allStates[x].prior
+                                                                                - params.priorNatMargin)
+                demMargin = stateMarginED + avgPolledPollError * rng.gauss(0, 1)
+                allStates[x].demMargin = demMargin
+
+            elif allStates[x].pollQuality == "None" and allStates[x].abbr != "NE" and allStates[x].abbr != "ME1" \
+            and allStates[x].abbr != "ME2":
+                stateMarginEDModifier = rng.gauss(0, params.noPollModifierSTD)
+                demMargin = (allStates[x].prior - params.priorNatMargin + natMarginED + stateMarginEDModifier
+                             + avgNationalPollError)
+                allStates[x].demMargin = demMargin
+
+                if allStates[x].abbr == "NE1" or allStates[x].abbr == "NE2" or allStates[x].abbr == "NE3":
+                    for z in allStates:
+                        if z.abbr == "NE":
+                            z.demMargin = z.demMargin + demMargin / 3
+
+            if allStates[x].abbr == "ME":
+                maineMargin = allStates[x].demMargin
+
+        districtDiff = rng.gauss(params.districtDiffMean, params.districtDiffSTD)
+        ME1margin = maineMargin + districtDiff / 2
+        ME2margin = 2 * maineMargin - ME1margin
+        for x in allStates:
+            if x.abbr == "ME1":
+                x.demMargin = ME1margin
+            elif x.abbr == "ME2":
+                x.demMargin = ME2margin
+
+            x.demAvg = x.demAvg + x.demMargin
+
+            if x.demMargin > 0:
+                demEVs = demEVs + x.evs
+                x.demWins = x.demWins + 1
+            else:
+                GOPEVs = GOPEVs + x.evs
+
+        avgDemEVs = avgDemEVs + demEVs
+        avgGOPEVs = avgGOPEVs + GOPEVs
+
+        if demEVs > GOPEVs:
+            demWins = demWins + 1
+        elif GOPEVs > demEVs:
+            GOPWins = GOPWins + 1
+        else:
+            ties = ties + 1
+
+        outcomes[bisect.bisect_right(OUTCOME_EDGES, demEVs - GOPEVs)] += 1
+
+        tipCount = 0
+        statesPos = 0
+        allStates = sorted(allStates, key=operator.attrgetter('demMargin'))
+        if demEVs > GOPEVs:
+            allStates.reverse()
+            while tipCount < 270:
+                tipCount = tipCount + allStates[statesPos].evs
+                statesPos = statesPos + 1
+        elif GOPEVs > demEVs:
+            while tipCount < 270:
+                tipCount = tipCount + allStates[statesPos].evs
+                statesPos = statesPos + 1
+        allStates[statesPos - 1].tip = allStates[statesPos - 1].tip + 1
+
+        for x in allStates:
+            x.demMargin = abs(x.demMargin)
+        allStates = sorted(allStates, key=operator.attrgetter('demMargin'))
+        smAssigned = False
+        smCount = 0
+        while smAssigned == False:
+            if allStates[smCount].abbr in ["ME1","ME2","NE1","NE2","NE3"]:
+                smCount = smCount + 1
+            else:
+                allStates[smCount].sm = allStates[smCount].sm + 1
+                smAssigned = True
+
+        if (natMarginED + avgNationalPollError > 0 and GOPEVs > demEVs) or (natMarginED + avgNationalPollError < 0
+            and GOPEVs < demEVs):
+            PVWinnerLoses = PVWinnerLoses + 1
+
+    allStates = sorted(allStates, key=lambda x: order[x.abbr])
+
+    return engine.Results(
+        abbrs=[x.abbr for x in allStates],
+        nSims=n_sims,
+        demWins=100 * demWins / n_sims,
+        GOPWins=100 * GOPWins / n_sims,
+        ties=100 * ties / n_sims,
+        avgDemEVs=avgDemEVs / n_sims,
+        avgGOPEVs=avgGOPEVs / n_sims,
+        PVWinnerLoses=100 * PVWinnerLoses / n_sims,
+        outcomes=100 * np.array(outcomes) / n_sims,
+        localeDemWins=100 * np.array([x.demWins for x in allStates]) / n_sims,
+        localeDemAvg=np.array([x.demAvg for x in allStates]) / n_sims,
+        localeTip=100 * np.array([x.tip for x in allStates]) / n_sims,
+        localeSm=100 * np.array([x.sm for x in allStates]) / n_sims,
+    )
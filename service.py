@@ -0,0 +1,491 @@
+import argparse
+import asyncio
+import collections
+import copy
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import engine
+import NeoSlim
+
+# A local HTTP service for running the model, so that dashboards and notebooks can ask for odds without each
+# loading the data and simulating for themselves. It is built on asyncio alone, and answers
+#
+#   POST /simulate  the national results of a simulation, as JSON
+#   POST /locales   the per-locale table of the same simulation: win %, average margin, tipping point % and
+#                   smallest margin % for each locale
+#   GET /stats      counts of the requests served, and of how many simulations they took
+#
+# The body of a POST says what to simulate, and every field is optional:
+#
+#   {"polls": {"PA": 5.1, "WI": 6.0}, "params": {"natMarginEDSTD": 3.0}, "sims": 100000, "seed": 0}
+#
+# "polls" overrides locales' polling margins (relative to the national polls, as in locales.csv) and "params"
+# overrides fields of engine.Params. A GET of /simulate or /locales simulates the service's defaults.
+#
+# Simulating takes from a fraction of a second to minutes, so it never happens on the event loop: requests are
+# queued, and every batchWindow seconds the queue is handed to a pool of worker processes. Requests are
+# coalesced on the way:
+#
+#   requests for the same scenario (polls, params, sims and seed) share one simulation, whether they arrive
+#   together or while it is running, and later ones are answered from a cache of recent results. Overrides are
+#   rounded to "resolution" points first, so near-identical requests (a poll average of 4.996 and one of 5.004)
+#   count as the same scenario; the difference is far below the Monte Carlo noise
+#   different scenarios with the same sims and seed go to the workers in batches, one per worker at most, and
+#   each batch makes each chunk's random draws once and applies every scenario in it to them (common random
+#   numbers, as in engine.run_many). Each scenario's results are exactly those of engine.run with its polls,
+#   params and seed, however it was batched
+#
+# A request without a seed gets the service's seed, so that repeated requests can be coalesced and give the
+# same answer. "python service.py --load-test 500" starts the service and fires requests at it from a stand-in
+# client, to check the throughput, the latency and how much work the coalescing saved
+
+# How long, in seconds, requests are collected before being sent to the workers as a batch
+
+batchWindow = 0.02
+
+# Overrides are rounded to this many points (or units of a Params field) before scenarios are compared
+
+resolution = 0.01
+
+# The most simulations a request may ask for, and the number of results kept for repeated requests
+
+maxSims = 10000000
+cacheSize = 256
+
+# The largest request body accepted, in bytes
+
+maxBody = 1 << 20
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           500: "Internal Server Error"}
+
+
+class Scenario(object):
+    """What a request asks to be simulated, validated and rounded so that it can be compared with others
+
+    polls maps the abbreviations of the locales whose polls are overridden to their new polling margins
+    params is the full engine.Params to simulate with, after the overrides
+    nSims and seed are the number of simulations and the seed
+    key identifies the scenario: two requests with the same key get the same results
+    """
+
+    def __init__(self, request, table, params, nSims, seed):
+        if not isinstance(request, dict):
+            raise ValueError("the request body should be a JSON object")
+        unknown = set(request) - {"polls", "params", "sims", "seed"}
+        if unknown:
+            raise ValueError("unknown fields " + ", ".join(sorted(unknown)))
+
+        polls = request.get("polls") or {}
+        overrides = request.get("params") or {}
+        if not isinstance(polls, dict) or not isinstance(overrides, dict):
+            raise ValueError("polls and params should be JSON objects")
+        for abbr in polls:
+            if abbr not in table.index:
+                raise ValueError("unknown locale " + repr(abbr))
+        for name in overrides:
+            if name not in engine.Params.FIELDS:
+                raise ValueError("unknown parameter " + repr(name))
+
+        self.polls = {x: rounded(polls[x]) for x in sorted(polls)}
+        self.params = params.replace(**{x: rounded(overrides[x]) for x in overrides})
+        for name in overrides:
+            if name.endswith("STD") and getattr(self.params, name) < 0:
+                raise ValueError(name + " is a standard deviation and can't be negative")
+        self.nSims = request.get("sims", nSims)
+        self.seed = request.get("seed", seed)
+        if not is_integer(self.nSims) or not 0 < self.nSims <= maxSims:
+            raise ValueError("sims should be a whole number from 1 to " + str(maxSims))
+        if not is_integer(self.seed) or self.seed < 0:
+            raise ValueError("seed should be a whole number from 0 up")
+
+        self.key = (tuple(self.polls.items()), tuple(sorted(self.params.as_dict().items())), self.nSims,
+                    self.seed)
+
+
+def is_integer(value):
+    """Returns whether a value from a request is a JSON integer (and not a float or a boolean)"""
+
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def rounded(value):
+    """Returns a number from a request rounded to the resolution, raising a ValueError if it isn't one"""
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("expected a number, not " + repr(value))
+    try:
+        if not math.isfinite(value):
+            raise ValueError("expected a finite number, not " + repr(value))
+        return round(round(value / resolution) * resolution, 10)
+    except OverflowError:
+        raise ValueError("expected a number of a sensible size")
+
+
+def batch_chunk(chunkSeed, chunkSims, table, tables, paramSets):
+    """Simulates a chunk of every scenario in a batch from one set of random draws, returning their Tallies
+
+    This is engine.run_chunk with a LocaleTable per scenario, as the scenarios may have different polls
+    """
+
+    draws = engine.draw_normals(np.random.default_rng(chunkSeed), chunkSims, table)
+    tallies = []
+    for scenarioTable, params in zip(tables, paramSets):
+        tally = engine.Tally(scenarioTable)
+        tally.add(*engine.compute_margins(draws, scenarioTable, params))
+        tallies.append(tally)
+    return tallies
+
+
+def simulate_batch(table, scenarios, n_sims, chunk_size, seed):
+    """Runs a batch of scenarios with the same number of simulations and seed, returning a Results for each
+
+    scenarios is a list of (polls, Params). This runs in a worker process, so it must be a top-level function
+    """
+
+    tables = []
+    for polls, params in scenarios:
+        scenarioTable = copy.copy(table)
+        scenarioTable.polls = table.polls.copy()
+        for abbr, value in polls.items():
+            scenarioTable.polls[table.index[abbr]] = value
+        tables.append(scenarioTable)
+
+    paramSets = [params for polls, params in scenarios]
+    tallies = [engine.Tally(x) for x in tables]
+    for chunk in engine.map_chunks(batch_chunk, table, (tables, paramSets), n_sims, chunk_size, seed, 1):
+        for tally, chunkTally in zip(tallies, chunk):
+            tally.merge(chunkTally)
+    return [x.results() for x in tallies]
+
+
+def national_json(results):
+    """Returns the national figures of a Results as a dict ready for JSON"""
+
+    return {
+        "nSims": int(results.nSims),
+        "demWins": float(results.demWins),
+        "GOPWins": float(results.GOPWins),
+        "ties": float(results.ties),
+        "avgDemEVs": float(results.avgDemEVs),
+        "avgGOPEVs": float(results.avgGOPEVs),
+        "PVWinnerLoses": float(results.PVWinnerLoses),
+        "demWinsSE": float(results.demWinsSE),
+        "avgDemEVsSE": float(results.avgDemEVsSE),
+        "outcomes": dict(zip(engine.OUTCOME_LABELS, results.outcomes.tolist())),
+    }
+
+
+def locales_json(results):
+    """Returns the per-locale table of a Results as a dict ready for JSON"""
+
+    rows = []
+    for x, abbr in enumerate(results.abbrs):
+        rows.append({
+            "abbr": abbr,
+            "demWins": float(results.localeDemWins[x]),
+            "demAvg": float(results.localeDemAvg[x]),
+            "tip": float(results.localeTip[x]),
+            "smallestMargin": float(results.localeSm[x]),
+        })
+    return {"nSims": int(results.nSims), "locales": rows}
+
+
+class Service(object):
+    """The simulations behind the HTTP service, batched and coalesced as described above
+
+    table and params are the locales and hyperparameters that requests override
+    nSims, seed and chunkSize are the defaults for requests and the chunk size for the workers
+    stats counts the requests ("requests"), those answered from the cache ("cacheHits") or by joining a
+    simulation already queued or running ("coalesced"), the batches sent to the workers ("batches") and the
+    scenarios and simulations they ran ("scenarios", "sims")
+    """
+
+    def __init__(self, table, params, n_sims=100000, seed=0, chunk_size=10000, workers=None, window=batchWindow):
+        self.table = table
+        self.params = params
+        self.nSims = n_sims
+        self.seed = seed
+        self.chunkSize = chunk_size
+        self.window = window
+        self.workers = workers or os.cpu_count()
+
+        # The workers are started afresh rather than forked, as forking a process whose event loop and pool
+        # threads are already running can leave a worker waiting forever on a lock held when it was forked
+
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.cache = collections.OrderedDict()
+        self.running = {}
+        self.queue = []
+        self.flushing = None
+        self.stats = dict.fromkeys(["requests", "cacheHits", "coalesced", "batches", "scenarios", "sims"], 0)
+
+    def scenario(self, request):
+        return Scenario(request, self.table, self.params, self.nSims, self.seed)
+
+    async def results(self, scenario):
+        """Returns the Results of a Scenario, simulating it unless it is cached or already on its way"""
+
+        self.stats["requests"] += 1
+        if scenario.key in self.cache:
+            self.stats["cacheHits"] += 1
+            self.cache.move_to_end(scenario.key)
+            return self.cache[scenario.key]
+
+        if scenario.key in self.running:
+            self.stats["coalesced"] += 1
+        else:
+            self.running[scenario.key] = asyncio.get_running_loop().create_future()
+            self.queue.append(scenario)
+            if self.flushing is None:
+                self.flushing = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+        # The future is shared, so a client which hangs up mustn't cancel it for the others
+
+        return await asyncio.shield(self.running[scenario.key])
+
+    def flush(self):
+        """Sends the queued scenarios to the workers, batched by their number of simulations and seed
+
+        Scenarios which could share a batch are split between up to one batch per worker, so that they are
+        simulated in parallel
+        """
+
+        self.flushing = None
+        groups = collections.defaultdict(list)
+        for scenario in self.queue:
+            groups[scenario.nSims, scenario.seed].append(scenario)
+        self.queue = []
+        for scenarios in groups.values():
+            for x in range(min(len(scenarios), self.workers)):
+                asyncio.get_running_loop().create_task(self.run_batch(scenarios[x::self.workers]))
+
+    async def run_batch(self, scenarios):
+        nSims, seed = scenarios[0].nSims, scenarios[0].seed
+        self.stats["batches"] += 1
+        self.stats["scenarios"] += len(scenarios)
+        self.stats["sims"] += nSims * len(scenarios)
+
+        try:
+            batch = [(x.polls, x.params) for x in scenarios]
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.pool, simulate_batch, self.table, batch, nSims, self.chunkSize, seed)
+        except Exception as error:
+            for scenario in scenarios:
+                self.running.pop(scenario.key).set_exception(error)
+            return
+
+        for scenario, result in zip(scenarios, results):
+            self.cache[scenario.key] = result
+            self.running.pop(scenario.key).set_result(result)
+        while len(self.cache) > cacheSize:
+            self.cache.popitem(last=False)
+
+    async def respond(self, method, path, body):
+        """Returns the (status, JSON-ready dict) answering a request"""
+
+        if path == "/stats":
+            if method != "GET":
+                return 405, {"error": "use GET for " + path}
+            return 200, dict(self.stats, running=len(self.running), cached=len(self.cache))
+
+        if path not in ("/simulate", "/locales"):
+            return 404, {"error": "no such endpoint " + repr(path)}
+        if method not in ("GET", "POST"):
+            return 405, {"error": "use GET or POST for " + path}
+
+        try:
+            request = json.loads(body) if method == "POST" and body.strip() else {}
+            scenario = self.scenario(request)
+        except (TypeError, ValueError) as error:
+            return 400, {"error": str(error)}
+
+        results = await self.results(scenario)
+        return 200, national_json(results) if path == "/simulate" else locales_json(results)
+
+    async def handle(self, reader, writer):
+        """Answers one HTTP request on a connection, then closes it"""
+
+        try:
+            try:
+                method, target, version = (await reader.readline()).decode("latin-1").split()
+                length = 0
+                while True:
+                    line = (await reader.readline()).decode("latin-1")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+            except ValueError:
+                status, payload = 400, {"error": "malformed HTTP request"}
+            else:
+                if not 0 <= length <= maxBody:
+                    status, payload = 413, {"error": "the request body is limited to " + str(maxBody) + " bytes"}
+                else:
+                    body = (await reader.readexactly(length)).decode("utf-8", "replace")
+                    try:
+                        status, payload = await self.respond(method.upper(), target.split("?")[0], body)
+                    except Exception as error:
+                        status, payload = 500, {"error": repr(error)}
+
+            content = json.dumps(payload).encode()
+            writer.write(("HTTP/1.1 " + str(status) + " " + REASONS[status] + "\r\n"
+                          "Content-Type: application/json\r\n"
+                          "Content-Length: " + str(len(content)) + "\r\n"
+                          "Connection: close\r\n\r\n").encode() + content)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+async def fetch(host, port, method, path, request=None):
+    """Makes one request of the service, returning (status, decoded JSON)"""
+
+    body = b"" if request is None else json.dumps(request).encode()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((method + " " + path + " HTTP/1.1\r\nHost: " + host + "\r\n"
+                      "Content-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\n"
+                      "Connection: close\r\n\r\n").encode() + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(content)
+
+
+async def load_test(host, port, requests=500, concurrency=50, scenarios=8, sims=100000, seed=0):
+    """Fires requests at a running service from a stand-in client and returns a dict of what happened
+
+    The requests are spread over a number of distinct scenarios (poll updates to PA and WI, and one
+    hyperparameter), each sent with a little jitter, well below the resolution, so that the service has to
+    recognise near-identical requests. A quarter go to /locales and the rest to /simulate. Meanwhile /stats is
+    polled, and the slowest reply shows whether the event loop stayed free while the workers simulated
+    """
+
+    rng = random.Random(seed)
+    bodies = []
+    for x in range(requests):
+        scenario = rng.randrange(scenarios)
+        bodies.append({
+            "polls": {"PA": 5.0 + 0.5 * (scenario % 4) + rng.uniform(-1, 1) * resolution / 4,
+                      "WI": 6.0 + rng.uniform(-1, 1) * resolution / 4},
+            "params": {"natMarginEDSTD": 2.5 + 0.25 * (scenario // 4)},
+            "sims": sims,
+        })
+
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(body, path):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            status, payload = await fetch(host, port, "POST", path, body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                failures += 1
+
+    pings = []
+    finished = asyncio.Event()
+
+    async def ping():
+        while not finished.is_set():
+            start = time.perf_counter()
+            await fetch(host, port, "GET", "/stats")
+            pings.append(time.perf_counter() - start)
+            await asyncio.sleep(0.05)
+
+    pinger = asyncio.create_task(ping())
+    start = time.perf_counter()
+    await asyncio.gather(*[one(body, "/locales" if x % 4 == 0 else "/simulate") for x, body in enumerate(bodies)])
+    elapsed = time.perf_counter() - start
+    finished.set()
+    await pinger
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "failures": failures,
+        "seconds": elapsed,
+        "requestsPerSecond": requests / elapsed,
+        "medianLatency": latencies[len(latencies) // 2],
+        "p95Latency": latencies[int(0.95 * (len(latencies) - 1))],
+        "maxLatency": latencies[-1],
+        "slowestStats": max(pings),
+        "server": (await fetch(host, port, "GET", "/stats"))[1],
+    }
+
+
+def print_load_test(report, sims):
+    server = report["server"]
+    print(report["requests"], "requests in", round(report["seconds"], 2), "s", "\t",
+          round(report["requestsPerSecond"], 1), "per second", "\t", report["failures"], "failed")
+    print("Latency:", "median", round(report["medianLatency"], 3), "s,", "95th percentile",
+          round(report["p95Latency"], 3), "s,", "max", round(report["maxLatency"], 3), "s", "\t",
+          "Slowest /stats reply:", round(report["slowestStats"], 4), "s")
+    print("Answered from the cache:", server["cacheHits"], "\t", "Coalesced with a running simulation:",
+          server["coalesced"])
+    print("Simulated", server["scenarios"], "scenarios in", server["batches"], "batches:", server["sims"],
+          "simulations rather than", report["requests"] * sims)
+
+
+async def serve(service, host, port, load=None, concurrency=50):
+    server = await asyncio.start_server(service.handle, host, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    async with server:
+        if load is None:
+            print("Serving on http://" + host + ":" + str(port))
+            await server.serve_forever()
+        else:
+            print_load_test(await load_test(host, port, load, concurrency, sims=service.nSims), service.nSims)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serves the election model over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (0 for any free port)")
+    parser.add_argument("--sims", type=int, default=100000, help="simulations for requests that don't say")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0, help="seed for requests that don't give one")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default one per CPU)")
+    parser.add_argument("--window", type=float, default=batchWindow,
+                        help="seconds to collect requests for before simulating them as a batch")
+    parser.add_argument("--data-dir", default=NeoSlim.dataDir, help="directory holding locales.csv")
+    parser.add_argument("--factors", help="file of correlated error factor loadings")
+    parser.add_argument("--load-test", type=int, metavar="REQUESTS",
+                        help="serve on a free port and fire this many requests at it from a stand-in client")
+    parser.add_argument("--concurrency", type=int, default=50, help="requests in flight at once in a load test")
+    args = parser.parse_args(argv)
+
+    config = NeoSlim.Config(dataDir=args.data_dir, factorsPath=args.factors)
+    table = NeoSlim.load_table(config)
+    service = Service(table, config.params, args.sims, args.seed, args.chunk_size, args.workers, args.window)
+    port = 0 if args.load_test is not None else args.port
+
+    try:
+        asyncio.run(serve(service, args.host, port, args.load_test, args.concurrency))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import json
+import os
+
+import numpy as np
+
+import engine
+
+# The engine only keeps running totals, so a question it wasn't asked up front, such as the chance that Biden
+# wins PA but loses GA, or the chance of a custom EV range, would need another full run. Instead, every simulation
+# can be written out to a draw store and queried afterwards as many times as needed.
+#
+# A draw store is a directory holding one .npy file per column, each with one row per simulation:
+#
+#   margins.npy is the Democratic margin in every locale, as float32
+#   demEVs.npy is the number of Democratic electoral votes, as int16 (the Republicans have the rest of the 538)
+#   popMargin.npy is the national popular vote margin, as float32
+#   tip.npy is the column of the tipping point locale, as int8
+#   meta.json holds the locale inputs, the Params, the seed and the number of simulations
+#
+# The columns are written a chunk at a time through memory maps, and read back the same way, so neither writing
+# nor querying a store of tens of millions of simulations needs more memory than a block of them at a time.
+# Stores are bulky (about 240 bytes per simulation for the 56 locales), so they are only written when asked for
+
+COLUMNS = {
+    "margins": np.float32,
+    "demEVs": np.int16,
+    "popMargin": np.float32,
+    "tip": np.int8,
+}
+
+
+def store_chunk(chunkSeed, chunkSims, table, params):
+    """Simulates a single chunk from its own seed and returns the columns to be stored for it
+
+    The draws are the same as those engine.run makes for the chunk with the same seed
+    """
+
+    draws = engine.draw_normals(np.random.default_rng(chunkSeed), chunkSims, table)
+    margins, natMarginED, avgNationalPollError = engine.compute_margins(draws, table, params)
+
+    demEVs = (margins > 0) @ table.evs
+    GOPEVs = table.evs.sum() - demEVs
+    tip = engine.find_tipping_points(margins, table.evs, demEVs, GOPEVs)
+
+    return {
+        "margins": margins,
+        "demEVs": demEVs,
+        "popMargin": natMarginED + avgNationalPollError,
+        "tip": tip,
+    }
+
+
+def write_store(path, table, params, n_sims=100000, chunk_size=10000, seed=None, workers=1):
+    """Runs n_sims simulations, as engine.run would, writing every one of them to a draw store at path
+
+    The directory is created if need be, and any store already there is overwritten. Returns the DrawStore
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        shape = (n_sims, len(table.abbrs)) if name == "margins" else (n_sims,)
+        columns[name] = np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype,
+                                                  shape=shape)
+
+    start = 0
+    for chunk in engine.map_chunks(store_chunk, table, (params,), n_sims, chunk_size, seed, workers):
+        rows = slice(start, start + len(chunk["demEVs"]))
+        for name, values in chunk.items():
+            columns[name][rows] = values
+        start = rows.stop
+
+    for column in columns.values():
+        column.flush()
+    del columns
+
+    meta = {
+        "abbrs": table.abbrs,
+        "pollQuality": [engine.QUALITY_NAMES[x] for x in table.quality],
+        "polls": table.polls.tolist(),
+        "priors": table.priors.tolist(),
+        "evs": table.evs.tolist(),
+        "factors": table.factors,
+        "loadings": table.loadings.tolist(),
+        "params": params.as_dict(),
+        "seed": seed,
+        "nSims": n_sims,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+    return DrawStore(path)
+
+
+class DrawBlock(object):
+    """A block of consecutive simulations from a DrawStore, as handed to query functions
+
+    margins, demEVs, popMargin and tip are the stored columns for the block's simulations (memory-mapped, so
+    they are only read from disk when used), and GOPEVs is the Republican electoral votes in each
+    """
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+        self.margins = store.margins[rows]
+        self.demEVs = store.demEVs[rows].astype(np.int64)
+        self.GOPEVs = store.evs.sum() - self.demEVs
+        self.popMargin = store.popMargin[rows]
+        self.tip = store.tip[rows]
+
+    def __len__(self):
+        return len(self.demEVs)
+
+    def margin(self, abbr):
+        """Returns the Democratic margin in a locale in each simulation"""
+
+        return self.margins[:, self.store.index[abbr]]
+
+    def won(self, abbr):
+        """Returns whether Biden won a locale in each simulation"""
+
+        return self.margin(abbr) > 0
+
+
+class DrawStore(object):
+    """A draw store opened for reading, with a query layer that works through it a block at a time
+
+    Events and values are given as functions of a DrawBlock, which return a boolean or numeric array with one
+    entry per simulation in the block, for example:
+
+        store.probability(lambda x: x.won("PA") & ~x.won("GA"))
+        store.probability(lambda x: x.demEVs > x.GOPEVs, given=lambda x: x.won("PA"))
+        store.histogram(lambda x: x.demEVs - x.GOPEVs, [-538, -100, 0, 100, 539])
+
+    table is a LocaleTable of the locale inputs the store was simulated from, and abbrs, index and evs are
+    copied from it for convenience. params is the engine.Params the store was simulated with and nSims is the
+    number of simulations. The columns are read-only memory maps, worked through blockSize simulations at a time
+    """
+
+    def __init__(self, path, block_size=250000):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.blockSize = block_size
+        self.table = engine.LocaleTable(meta["abbrs"], meta["pollQuality"], meta["polls"], meta["priors"],
+                                        meta["evs"])
+        self.table.set_loadings(meta["factors"], meta["loadings"])
+        self.abbrs = self.table.abbrs
+        self.index = self.table.index
+        self.evs = self.table.evs
+        self.params = engine.Params(**meta["params"])
+        self.seed = meta["seed"]
+        self.nSims = meta["nSims"]
+
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return self.nSims
+
+    def blocks(self):
+        """Yields the store as a series of DrawBlocks of at most blockSize simulations"""
+
+        for start in range(0, self.nSims, self.blockSize):
+            yield DrawBlock(self, slice(start, start + self.blockSize))
+
+    def count(self, where=None):
+        """Returns the number of simulations in which where is true (all of them if where is None)"""
+
+        if where is None:
+            return self.nSims
+        return sum(int(np.count_nonzero(where(x))) for x in self.blocks())
+
+    def probability(self, event, given=None):
+        """Returns the percentage of simulations in which event happened, out of those in which given is true
+
+        Returns NaN if given is never true
+        """
+
+        hits = 0
+        total = 0
+        for block in self.blocks():
+            happened = event(block)
+            if given is not None:
+                condition = given(block)
+                happened = happened & condition
+                total += int(np.count_nonzero(condition))
+            else:
+                total += len(block)
+            hits += int(np.count_nonzero(happened))
+
+        return 100 * hits / total if total else float("nan")
+
+    def mean(self, value, where=None):
+        """Returns the average of value over the simulations in which where is true, or NaN if there are none"""
+
+        total = 0.0
+        count = 0
+        for block in self.blocks():
+            values = np.asarray(value(block), dtype=np.float64)
+            if where is not None:
+                values = values[where(block)]
+            total += values.sum()
+            count += len(values)
+
+        return total / count if count else float("nan")
+
+    def histogram(self, value, edges, where=None):
+        """Returns the percentage of the simulations in which where is true that fall into each bin of value
+
+        The bins are np.histogram's: each runs from its edge up to, but not including, the next, apart from the
+        last, which includes its upper edge too. Values outside the edges aren't counted, so the percentages are
+        of the simulations that fall within them
+        """
+
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for block in self.blocks():
+            values = value(block)
+            if where is not None:
+                values = values[where(block)]
+            counts += np.histogram(values, edges)[0]
+
+        total = counts.sum()
+        return 100 * counts / total if total else np.full(len(counts), np.nan)
+
+    def results(self):
+        """Tallies the stored simulations into an engine.Results object, as engine.run would have returned
+
+        The margins were stored as float32, so the averages can differ from engine.run's in the last few digits
+        """
+
+        tally = engine.Tally(self.table)
+        for block in self.blocks():
+            tally.add(block.margins, block.popMargin, np.zeros(len(block)), block.demEVs)
+        return tally.results()
@@ -0,0 +1,59 @@
+import csv
+import itertools
+
+import engine
+
+# Runs the model over many sets of hyperparameters at once, for sensitivity analysis. Every scenario is applied
+# to the same random draws, which are made once per chunk and shared, so a sweep of hundreds of scenarios costs
+# little more than the margin and tally arithmetic for each one, and the differences between scenarios are due
+# to the parameters alone
+
+
+def grid(base=None, **values):
+    """Returns a list of Params covering every combination of the given values
+
+    For example grid(natMarginEDSTD=[2, 2.5, 3], noPollModifierSTD=[5, 5.59]) gives six sets of Params. Anything
+    not varied is taken from base (by default the engine.Params defaults)
+    """
+
+    if base is None:
+        base = engine.Params()
+
+    names = list(values)
+    return [base.replace(**dict(zip(names, combination)))
+            for combination in itertools.product(*[values[x] for x in names])]
+
+
+def sweep(table, paramSets, n_sims=100000, chunk_size=10000, seed=None, workers=1):
+    """Runs every set of Params over the same draws and returns a tidy table with one row per scenario
+
+    Each row is a dict holding the scenario's parameters followed by its win percentages, average EVs, the chance
+    of the popular vote winner losing, and the percentage in each Electoral College margin bin
+    """
+
+    rows = []
+    allResults = engine.run_many(table, paramSets, n_sims=n_sims, chunk_size=chunk_size, seed=seed,
+                                 workers=workers, tips=False)
+
+    for params, results in zip(paramSets, allResults):
+        row = params.as_dict()
+        row["demWins"] = results.demWins
+        row["GOPWins"] = results.GOPWins
+        row["ties"] = results.ties
+        row["avgDemEVs"] = results.avgDemEVs
+        row["avgGOPEVs"] = results.avgGOPEVs
+        row["PVWinnerLoses"] = results.PVWinnerLoses
+        for label, outcome in zip(engine.OUTCOME_LABELS, results.outcomes):
+            row[label] = float(outcome)
+        rows.append(row)
+
+    return rows
+
+
+def write_csv(rows, path):
+    """Writes the table returned by sweep to a CSV file"""
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)